@@ -1,30 +1,47 @@
-import os
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import Field
 from pydantic import BaseModel
 from typing import List, Optional
-from dotenv import load_dotenv
 
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, aclosing
 
 import uuid
+import json
+import hmac
+import asyncio
 from datetime import datetime
 
-from app.memory import RedisMemory
-from app.tools import CACHE_MENU_EMBEDDINGS
+# Só módulos leves no import: pydantic_ai, openai, numpy, redis e httpx entram no lifespan
+# (ou no primeiro uso), para o pod subir e responder /health o quanto antes.
+from app.config import get_settings
 from app.upsell import UpsellManager
-from pydantic_ai.messages import ModelResponse, TextPart
-from app.agent import menux_agent
-from app.models import MenuxDeps, MenuxResponse
-from app.tools import fetch_category_names, refresh_menu_embeddings
+from app.models import MenuxDeps, MenuxResponse, ChatResponse, ResponseMeta, SuggestionRequest
+from app.scheduler import llm_scheduler, current_restaurant, SchedulerOverloaded
+from app.deadline import Deadline, current_deadline, record_fallback
+from app.usage import UsageRecord, current_usage, record_usage
+from app.circuit import circuits, chat_circuit, CircuitOpen
+from app.profiling import profiler, ProfilingMiddleware, PROFILE_SAMPLE_RATE, PROFILE_SLOW_MS
+from app import metrics
+
+settings = get_settings()
 
 # 2. Estado Global (Cache de Contexto)
 class APIState:
     def __init__(self):
         self.deps = MenuxDeps()
+        self.memory = None # RedisMemory, criado no lifespan
+        self.warmup: Optional[asyncio.Task] = None
 
 state = APIState()
-memory_client = RedisMemory() # Conecta ao Redis
+
+def _warm_imports():
+    """Importa os módulos pesados (agente, tools, SDKs). Roda em thread para não travar o loop."""
+    import app.agent  # noqa: F401 (monta o menux_agent)
+    import app.speculation  # noqa: F401
+    from app.tools import get_openai_client
+    get_openai_client()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -33,11 +50,27 @@ async def lifespan(app: FastAPI):
     Substitui o antigo @app.on_event("startup").
     """
     print("🤖 Iniciando Menux AI Server...")
+    from app.memory import RedisMemory
+    state.memory = RedisMemory(settings.redis_url) # Conecta ao Redis
+
+    # Aquecimento em background: /health já responde enquanto o agente é montado.
+    # O primeiro /chat espera o warmup terminar (ver _ready).
+    state.warmup = asyncio.create_task(asyncio.to_thread(_warm_imports))
+
     # O carregamento do cardápio agora é feito sob demanda por restaurante
     yield  # Aqui a API fica rodando
     
     print("👋 Encerrando Menux AI Server.")
 
+async def _ready():
+    if state.warmup is not None:
+        await state.warmup
+
+def _is_ready() -> bool:
+    """Aquecimento concluído sem erro: o pod já atende /chat sem esperar imports."""
+    warmup = state.warmup
+    return warmup is None or (warmup.done() and not warmup.cancelled() and warmup.exception() is None)
+
 app = FastAPI(title="Menux AI API", lifespan=lifespan)
 
 # 3. CORS - Necessário para o Frontend
@@ -49,39 +82,141 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Profiling opt-in (PROFILE_SAMPLE_RATE > 0): guarda perfis das requisições lentas.
+# Desligado, nem registra o middleware (middleware tem custo em toda requisição).
+if PROFILE_SAMPLE_RATE > 0:
+    app.add_middleware(ProfilingMiddleware)
+
+# Token das rotas /admin (se vazio, as rotas ficam fechadas)
+ADMIN_TOKEN = settings.admin_token
+
 # 4. Modelos de Entrada/Saída
+# O restaurantId vira label de métrica e chave dos limites por restaurante: só ids curtos e sem caracteres especiais
+RESTAURANT_ID_PATTERN = r"^[A-Za-z0-9_-]{1,64}$"
+
 class ChatRequest(BaseModel):
     mensagem: str
-    restaurantId: str
+    restaurantId: str = Field(..., pattern=RESTAURANT_ID_PATTERN)
     session_id: Optional[str] = None # Opcional por enquanto, se não vier geramos um uuid
 
+class BatchRecommendRequest(BaseModel):
+    restaurantId: str = Field(..., pattern=RESTAURANT_ID_PATTERN)
+    queries: List[SuggestionRequest] = Field(..., min_length=1, max_length=500)
+    rerank: bool = False # Reranking LLM é opcional (mais lento e caro)
+    max_concurrency: int = Field(4, ge=1, le=16) # Reranks simultâneos
+
+# Embedding de centenas de queries numa chamada só merece um teto maior que o de /chat
+BATCH_EMBEDDING_TIMEOUT = 30.0
+
+
+# Resposta quando o agente estoura o prazo da requisição
+AGENT_TIMEOUT_MESSAGE = "Desculpe a demora! A cozinha está agitada agora. Pode repetir o seu pedido?"
+# Resposta imediata quando o circuito do chat (OpenAI) está aberto
+AGENT_UNAVAILABLE_MESSAGE = "Estou com uma instabilidade agora e não consigo montar sugestões. Pode tentar de novo em instantes?"
+
+metrics.describe("menux_chat_seconds", "Latência total do /chat.")
+
+def _record_agent_usage(usage: UsageRecord, run_usage, model: str):
+    """Consumo do agente (todas as idas ao LLM do turno) e quantas idas foram."""
+    record_usage(
+        "agent",
+        model,
+        input_tokens=run_usage.input_tokens,
+        output_tokens=run_usage.output_tokens,
+        cached_tokens=run_usage.cache_read_tokens,
+        requests=run_usage.requests,
+    )
+    usage.agent_round_trips += run_usage.requests
+    # O prompt pede UMA chamada de tool: mais de 2 idas por turno indica o agente repetindo a busca
+    metrics.observe("menux_agent_round_trips", run_usage.requests, buckets=(1, 2, 3, 4, 6, 8), restaurant=usage.restaurant_id)
+
+def _with_meta(output: MenuxResponse, deadline: Deadline) -> ChatResponse:
+    elapsed = deadline.elapsed()
+    metrics.observe("menux_chat_seconds", elapsed)
+    return ChatResponse(
+        **output.model_dump(),
+        meta=ResponseMeta(fallbacks=deadline.fallbacks, elapsed_ms=int(elapsed * 1000)),
+    )
 
 # 5. Rota Principal de Chat
-@app.post("/chat", response_model=MenuxResponse)
-async def chat(request: ChatRequest):
+@app.post("/chat", response_model=ChatResponse)
+async def chat(
+    request: ChatRequest,
+    response: Response,
+    x_menux_debug: Optional[str] = Header(None),
+):
     if not request.mensagem:
         raise HTTPException(status_code=400, detail="Mensagem vazia")
+
+    # Orçamento de latência da requisição, visto por todos os estágios (tools, embeddings, reranking)
+    deadline = Deadline()
+    current_deadline.set(deadline)
+    # Consumo de tokens da requisição (agente + reranker + embeddings). Com X-Menux-Debug volta no header X-Menux-Usage
+    usage = UsageRecord(request.restaurantId)
+    current_usage.set(usage)
     
     session_id = request.session_id # Ou criar um se não vier (mas idealmente o front deve mandar)
     if not session_id:
         session_id = str(uuid.uuid4())
 
+    speculation = None
+    # Consumo do agente: preenchido pelo PydanticAI a cada ida ao LLM, então vale mesmo se o turno estourar o prazo
+    run_usage = None
     try:
-        # 1. Carrega histórico do Redis
-        history = await memory_client.get_history(session_id)
-        
-        # Carrega ou obtém categorias do cache para o restaurantId
-        categorias = await fetch_category_names(request.restaurantId)
-        req_deps = MenuxDeps(categorias_str=categorias, restaurantId=request.restaurantId)
-        
-        # 2. Executa o Agente com histórico persistido
-        result = await menux_agent.run(
-            request.mensagem, 
-            deps=req_deps,
-            message_history=history
-        )
+        # OpenAI fora do ar: responde na hora em vez de esperar o prazo inteiro
+        if chat_circuit.is_open():
+            record_fallback("agent_circuit_open")
+            return _with_meta(MenuxResponse(resposta_chat=AGENT_UNAVAILABLE_MESSAGE), deadline)
+
+        await _ready()
+        from pydantic_ai.messages import ModelResponse, TextPart
+        from pydantic_ai.usage import RunUsage
+        from app.agent import menux_agent, AGENT_MODEL
+        from app.speculation import start_speculation
+        from app.tools import fetch_category_names, CACHE_MENU_EMBEDDINGS
+
+        # O slot LLM cobre a requisição inteira (tools aninhadas e a especulação reaproveitam o mesmo slot).
+        # Sem capacidade -> SchedulerOverloaded -> 429 com Retry-After.
+        current_restaurant.set(request.restaurantId)
+        try:
+            async with llm_scheduler.slot(request.restaurantId):
+                # 1. Embedding especulativo da mensagem, em paralelo com tudo que vem abaixo
+                # (se o agente chamar a busca com um pedido parecido, o vetor já está pronto)
+                speculation = start_speculation(request.mensagem)
+
+                # Carrega histórico do Redis e categorias do restaurantId em paralelo
+                history, categorias = await asyncio.gather(
+                    state.memory.get_history(session_id),
+                    fetch_category_names(request.restaurantId),
+                )
+                req_deps = MenuxDeps(
+                    categorias_str=categorias,
+                    restaurantId=request.restaurantId,
+                    speculation=speculation,
+                    session_id=session_id,
+                )
+
+                # 2. Executa o Agente com histórico persistido
+                # (o circuit breaker do chat fica em volta de cada ida ao LLM, ver CircuitBreakerModel)
+                run_usage = RunUsage()
+                result = await asyncio.wait_for(
+                    menux_agent.run(
+                        request.mensagem, 
+                        deps=req_deps,
+                        message_history=history,
+                        usage=run_usage,
+                    ),
+                    timeout=deadline.remaining(),
+                )
+        except asyncio.TimeoutError:
+            # Prazo total estourado: responde algo útil em vez de segurar o cliente
+            record_fallback("agent_timeout")
+            return _with_meta(MenuxResponse(resposta_chat=AGENT_TIMEOUT_MESSAGE), deadline)
+        except CircuitOpen:
+            # Circuito abriu durante o turno, ou outra requisição está testando (meio-aberto)
+            record_fallback("agent_circuit_open")
+            return _with_meta(MenuxResponse(resposta_chat=AGENT_UNAVAILABLE_MESSAGE), deadline)
         
-        from app.tools import CACHE_MENU_EMBEDDINGS
         restaurant_cache = CACHE_MENU_EMBEDDINGS.get(request.restaurantId, {})
         
         upsell_data = await UpsellManager.check_upsell(
@@ -104,18 +239,106 @@ async def chat(request: ChatRequest):
             new_msgs.append(fake_upsell_msg)
 
         # 4. Salva novo histórico (append das novas mensagens + upsell se houver)
-        await memory_client.save_history(session_id, new_msgs)
+        await state.memory.save_history(session_id, new_msgs)
         
-        return result.output
+        return _with_meta(result.output, deadline)
         
+    except SchedulerOverloaded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         print(f"Erro no processamento do chat: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if speculation:
+            speculation.finish()
+        if run_usage is not None:
+            _record_agent_usage(usage, run_usage, AGENT_MODEL)
+        if x_menux_debug:
+            response.headers["X-Menux-Usage"] = json.dumps(usage.to_dict(), separators=(",", ":"))
+
+# 6. Recomendações em Lote (kiosk, marketing)
+@app.post("/recommend/batch")
+async def recommend_batch_route(batch: BatchRecommendRequest):
+    """
+    Recomendações para muitas queries de uma vez, com o mesmo núcleo de busca do chat.
+    Um único embeddings.create para todas as queries + uma multiplicação de matrizes.
+    Resposta em NDJSON: uma linha por query, na ordem em que ficam prontas.
+    """
+    await _ready()
+    from app.tools import get_menu_index, get_embeddings, recommend_batch
+
+    current_restaurant.set(batch.restaurantId)
 
-# 6. Rota de Saúde (Healthcheck)
+    index = await get_menu_index(batch.restaurantId)
+    if index is None:
+        raise HTTPException(status_code=404, detail="Cardápio indisponível para este restaurante")
+
+    try:
+        query_vecs = await get_embeddings(
+            [q.pedido_usuario for q in batch.queries],
+            restaurant_id=batch.restaurantId,
+            timeout=BATCH_EMBEDDING_TIMEOUT,
+            tool="batch_embedding",
+        )
+    except SchedulerOverloaded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    # Embeddings indisponíveis (erro, timeout ou circuito aberto): busca lexical, como no chat
+    if len(query_vecs) != len(batch.queries):
+        query_vecs = None
+
+    async def _stream():
+        # aclosing: se a resposta for interrompida, o gerador do lote fecha já (e cancela os reranks pendentes)
+        async with aclosing(recommend_batch(
+            index, batch.queries, query_vecs, rerank=batch.rerank, max_concurrency=batch.max_concurrency
+        )) as results:
+            async for position, result in results:
+                line = {
+                    "index": position,
+                    "pedido_usuario": batch.queries[position].pedido_usuario,
+                    **result.model_dump(),
+                }
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
+
+# 7. Rota de Saúde (Healthcheck)
+# 503 enquanto o aquecimento não termina: serve de readiness probe (o processo já está vivo)
 @app.get("/health")
-async def health():
-    return {"status": "online", "menu_loaded": bool(state.deps.categorias_str)}
+async def health(response: Response):
+    ready = _is_ready()
+    if not ready:
+        response.status_code = 503
+    return {
+        "status": "online" if ready else "warming_up",
+        "ready": ready,
+        "menu_loaded": bool(state.deps.categorias_str),
+        "scheduler": llm_scheduler.snapshot(),
+        "circuits": {name: circuit.state for name, circuit in circuits.items()},
+    }
+
+# 8. Métricas (formato Prometheus)
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return metrics.render()
+
+# 9. Perfis das requisições lentas (flame data)
+@app.get("/admin/profiles")
+async def admin_profiles(format: str = "json", x_admin_token: Optional[str] = Header(None)):
+    """
+    Perfis guardados no ring buffer. `format=collapsed` devolve as stacks somadas
+    no formato collapsed (entrada do flamegraph.pl / speedscope).
+    """
+    # Sem ADMIN_TOKEN configurado as rotas /admin ficam fechadas
+    if not ADMIN_TOKEN or not hmac.compare_digest((x_admin_token or "").encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Token inválido")
+
+    if format == "collapsed":
+        return PlainTextResponse(profiler.collapsed())
+    return {
+        "sample_rate": PROFILE_SAMPLE_RATE,
+        "slow_ms": PROFILE_SLOW_MS,
+        "profiles": list(profiler.slow_profiles),
+    }
 
 if __name__ == "__main__":
     import uvicorn
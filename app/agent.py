@@ -1,18 +1,47 @@
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone, timedelta
+from typing import Any, AsyncIterator, Awaitable, Callable, List
 from pydantic_ai import Agent, RunContext
-from dotenv import load_dotenv
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.models.wrapper import WrapperModel
+from pydantic_ai.providers.openai import OpenAIProvider
 
+from . import metrics
 from .models import MenuxResponse, SuggestionRequest, SuggestionResult, MenuxDeps
-from .tools import agente_gastronomico, pick_random_items
+from .tools import agente_gastronomico, pick_random_items, get_items_by_ids, get_openai_client
 from .logger import VisualLogger
 from .prompts import SYSTEM_PROMPT
+from .circuit import chat_circuit
+from .deadline import AGENT_REQUEST_TIMEOUT
 
-load_dotenv()
+# Modelo do agente (também usado como label nas métricas de consumo)
+AGENT_MODEL = "gpt-4o-mini"
 
+class CircuitBreakerModel(WrapperModel):
+    """
+    Modelo do agente com o circuit breaker do chat em volta de CADA ida ao LLM.
+    Tools lentas, prazo da requisição e erros de comportamento do modelo (ex.: retries da tool
+    esgotados) ficam de fora: só falhas da própria chamada à OpenAI contam.
+    """
+
+    async def request(self, *args: Any, **kwargs: Any):
+        async with chat_circuit.guard():
+            return await super().request(*args, **kwargs)
+
+    @asynccontextmanager
+    async def request_stream(self, *args: Any, **kwargs: Any) -> AsyncIterator[Any]:
+        async with chat_circuit.guard():
+            async with super().request_stream(*args, **kwargs) as response_stream:
+                yield response_stream
+
+# Mesmo cliente OpenAI das tools (sem retry do SDK); cada ida ao LLM tem seu próprio teto,
+# abaixo do orçamento, para um upstream travado estourar no SDK e contar no breaker
 menux_agent = Agent(
-    'openai:gpt-4o-mini',
+    CircuitBreakerModel(OpenAIChatModel(AGENT_MODEL, provider=OpenAIProvider(openai_client=get_openai_client()))),
     output_type=MenuxResponse,
     deps_type=MenuxDeps,
+    model_settings={"timeout": AGENT_REQUEST_TIMEOUT},
 )
 
 @menux_agent.system_prompt
@@ -34,6 +63,27 @@ def get_system_prompt(ctx: RunContext[MenuxDeps]) -> str:
     
     return final_prompt
 
+metrics.describe("menux_tool_call_dedup_total", "Chamadas de tool repetidas (mesmos argumentos) respondidas do cache da execução.")
+
+async def _memoized(ctx: RunContext[MenuxDeps], tool_name: str, req: SuggestionRequest, run: Callable[[], Awaitable[SuggestionResult]]) -> SuggestionResult:
+    """
+    Mesma tool com os mesmos argumentos na mesma execução do agente devolve o resultado anterior.
+    Guarda a task (não o resultado) para que chamadas paralelas idênticas também compartilhem.
+    O cache é por `run_id`: deps reaproveitadas no turno seguinte (main.py) não devolvem resultado velho.
+    """
+    cache = ctx.deps.tool_cache.get(ctx.run_id)
+    if cache is None:
+        # Nova execução: descarta o que ficou das anteriores
+        ctx.deps.tool_cache.clear()
+        cache = ctx.deps.tool_cache[ctx.run_id] = {}
+
+    key = f"{tool_name}:{req.model_dump_json()}"
+    if key in cache:
+        metrics.inc("menux_tool_call_dedup_total", tool=tool_name)
+    else:
+        cache[key] = asyncio.ensure_future(run())
+    return await cache[key]
+
 @menux_agent.tool
 async def consultar_cardapio(ctx: RunContext[MenuxDeps], req: SuggestionRequest) -> SuggestionResult:
     """
@@ -51,7 +101,12 @@ async def consultar_cardapio(ctx: RunContext[MenuxDeps], req: SuggestionRequest)
     - Se vieram itens misturados, FILTRE na sua resposta textual, não chame a tool novamente.
     """
     # vai buscar direto da API. Aqui é só ponte.
-    return await agente_gastronomico(req, restaurant_id=ctx.deps.restaurantId)
+    return await _memoized(ctx, "consultar_cardapio", req, lambda: agente_gastronomico(
+        req,
+        restaurant_id=ctx.deps.restaurantId,
+        speculation=ctx.deps.speculation,
+        session_id=ctx.deps.session_id,
+    ))
 
 @menux_agent.tool
 async def surpreenda_me(ctx: RunContext[MenuxDeps], req: SuggestionRequest) -> SuggestionResult:
@@ -63,9 +118,12 @@ async def surpreenda_me(ctx: RunContext[MenuxDeps], req: SuggestionRequest) -> S
      NÃO use se o usuário tiver intenção clara de busca (ex: "Quero algo com carne").
     """
     
+    return await _memoized(ctx, "surpreenda_me", req, lambda: _surpreenda_me(ctx, req))
+
+async def _surpreenda_me(ctx: RunContext[MenuxDeps], req: SuggestionRequest) -> SuggestionResult:
     VisualLogger.log_tool_call("surpreenda_me", req.model_dump())
     
-    items = await pick_random_items(qtd=3, category_focus=req.categoria_foco.value, restaurant_id=ctx.deps.restaurantId)
+    items = await pick_random_items(qtd=3, category_focus=req.categoria_foco.value, restaurant_id=ctx.deps.restaurantId, req=req)
     
     if not items:
         return SuggestionResult(sugestoes=[])
@@ -73,3 +131,15 @@ async def surpreenda_me(ctx: RunContext[MenuxDeps], req: SuggestionRequest) -> S
     res = SuggestionResult(sugestoes=items)
     VisualLogger.log_tool_result(res, success=True)
     return res
+
+@menux_agent.tool
+async def detalhar_itens(ctx: RunContext[MenuxDeps], ids: List[str]) -> SuggestionResult:
+    """
+    Retorna descrição e categoria de itens JÁ SUGERIDOS em turnos anteriores.
+    O histórico guarda apenas id, nome e preço das sugestões antigas.
+
+    Use APENAS quando o usuário perguntar algo sobre um item já sugerido que dependa da
+    descrição (ingredientes, acompanhamentos, tamanho). NÃO use para buscar novas opções.
+    """
+    VisualLogger.log_tool_call("detalhar_itens", {"ids": ids})
+    return SuggestionResult(sugestoes=await get_items_by_ids(ctx.deps.restaurantId, ids))
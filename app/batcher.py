@@ -0,0 +1,134 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from . import metrics
+from .config import get_settings
+
+_settings = get_settings()
+
+# Janela para juntar pedidos concorrentes (ms) e tamanho máximo do lote
+EMBEDDING_BATCH_WINDOW_MS = _settings.embedding_batch_window_ms
+EMBEDDING_BATCH_MAX_SIZE = _settings.embedding_batch_max_size
+# Lotes em andamento ao mesmo tempo: com o upstream lento, os próximos esperam em vez de empilhar chamadas
+EMBEDDING_BATCH_MAX_IN_FLIGHT = _settings.embedding_batch_max_in_flight
+
+metrics.describe("menux_embedding_batch_size", "Textos por chamada embeddings.create feita pelo micro-batcher.")
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batching de embeddings de texto único.
+
+    Corrotinas concorrentes chamam `embed(text)`; os pedidos que chegam dentro da janela
+    (ou até encher o lote) viram UMA chamada `embeddings.create` e cada chamador recebe
+    o seu vetor. Se a chamada em lote for recusada por entrada inválida (`is_input_error`),
+    cada texto é tentado sozinho, para que um texto ruim não derrube os outros. Qualquer outro
+    erro (rede, 5xx, 429, circuito aberto) é do upstream: falha o lote todo, sem N chamadas extras.
+
+    No máximo `max_in_flight` lotes vão à OpenAI ao mesmo tempo, e um lote cujos chamadores
+    já desistiram (timeout/cancelamento) é cancelado, esteja na espera ou no meio da chamada.
+
+    `embed_many` devolve (vetores, tokens do lote). A OpenAI só informa o total, então cada
+    chamador recebe uma parte proporcional ao tamanho do seu texto (para contabilizar o consumo).
+    """
+
+    def __init__(
+        self,
+        embed_many: Callable[[List[str]], Awaitable[Tuple[List[List[float]], int]]],
+        window_ms: float = EMBEDDING_BATCH_WINDOW_MS,
+        max_batch_size: int = EMBEDDING_BATCH_MAX_SIZE,
+        max_in_flight: int = EMBEDDING_BATCH_MAX_IN_FLIGHT,
+        is_input_error: Callable[[Exception], bool] = lambda error: False,
+    ):
+        self.embed_many = embed_many
+        self.is_input_error = is_input_error
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._queue: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def embed(self, text: str) -> Tuple[List[float], float]:
+        """Vetor do texto e a parte dos tokens do lote que cabe a este pedido."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._queue.append((text, fut))
+
+        if len(self._queue) >= self.max_batch_size:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._schedule_flush)
+
+        return await fut
+
+    def _schedule_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._queue = self._queue, []
+        if not batch:
+            return
+        task = asyncio.create_task(self._flush(batch))
+        # Guarda referência até terminar (o loop só mantém weakref das tasks)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self._cancel_when_abandoned(task, [fut for _, fut in batch])
+
+    @staticmethod
+    def _cancel_when_abandoned(task: asyncio.Task, futures: List[asyncio.Future]):
+        # Todos os chamadores já têm resposta (ou desistiram): a chamada do lote não serve a mais ninguém
+        def _check(_):
+            if not task.done() and all(fut.done() for fut in futures):
+                task.cancel()
+
+        for fut in futures:
+            fut.add_done_callback(_check)
+
+    async def _flush(self, batch: List[Tuple[str, asyncio.Future]]):
+        async with self._in_flight:
+            await self._embed_batch(batch)
+
+    async def _embed_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        # Quem já desistiu (timeout/cancelamento) não entra no lote
+        batch = [(text, fut) for text, fut in batch if not fut.done()]
+        if not batch:
+            return
+
+        # Textos repetidos no mesmo lote vão uma vez só
+        unique_texts = list(dict.fromkeys(text for text, _ in batch))
+        metrics.observe("menux_embedding_batch_size", len(unique_texts), buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+
+        results: Dict[str, object] = {}
+        try:
+            vectors, tokens = await self.embed_many(unique_texts)
+            total_chars = sum(len(text) for text in unique_texts) or 1
+            for text, vector in zip(unique_texts, vectors):
+                results[text] = (vector, tokens * len(text) / total_chars)
+        except Exception as e:
+            if len(unique_texts) == 1 or not self.is_input_error(e):
+                results = dict.fromkeys(unique_texts, e)
+            else:
+                # Isola as falhas: cada texto tenta sozinho
+                singles = await asyncio.gather(
+                    *(self.embed_many([text]) for text in unique_texts), return_exceptions=True
+                )
+                for text, single in zip(unique_texts, singles):
+                    results[text] = single if isinstance(single, BaseException) else (single[0][0], single[1])
+
+        # Texto repetido: os tokens dele são divididos entre quem pediu
+        callers: Dict[str, int] = {}
+        for text, _ in batch:
+            callers[text] = callers.get(text, 0) + 1
+
+        for text, fut in batch:
+            if fut.done():
+                continue
+            result = results.get(text)
+            if isinstance(result, BaseException):
+                fut.set_exception(result)
+            elif result is None:
+                fut.set_exception(RuntimeError("Embedding ausente na resposta do lote"))
+            else:
+                vector, tokens = result
+                fut.set_result((vector, tokens / callers[text]))
@@ -0,0 +1,149 @@
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import Dict
+
+from . import metrics
+from .config import get_settings
+
+_settings = get_settings()
+
+# Falhas seguidas para abrir o circuito e quanto tempo ele fica aberto antes de deixar uma chamada de teste
+CIRCUIT_FAILURE_THRESHOLD = _settings.circuit_failure_threshold
+CIRCUIT_RESET_SECONDS = _settings.circuit_reset_seconds
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+# Valor do gauge por estado
+_STATE_VALUE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+metrics.describe("menux_circuit_state", "Estado do circuit breaker por upstream (0 = fechado, 1 = meio-aberto, 2 = aberto).")
+metrics.describe("menux_circuit_transitions_total", "Mudanças de estado do circuit breaker.")
+metrics.describe("menux_circuit_rejected_total", "Chamadas recusadas na hora porque o circuito estava aberto.")
+
+
+class CircuitOpen(Exception):
+    """O upstream está fora (circuito aberto): use o fallback sem esperar timeout."""
+
+    def __init__(self, upstream: str):
+        super().__init__(f"Circuito aberto para {upstream}")
+        self.upstream = upstream
+
+
+def is_upstream_status(status: int) -> bool:
+    """Status HTTP que indica upstream com problema (5xx ou 429), não erro do nosso pedido."""
+    return status >= 500 or status == 429
+
+
+def is_upstream_error(error: BaseException) -> bool:
+    """
+    Erro que conta como falha do upstream: conexão, timeout do próprio cliente HTTP/SDK, 5xx e 429.
+    Outros 4xx e erros da aplicação (validação, comportamento do modelo) não contam.
+    Erros embrulhados (o PydanticAI levanta `ModelAPIError` `from` o erro do SDK) são olhados pela causa.
+    """
+    while error is not None:
+        if _is_upstream_error(error):
+            return True
+        error = error.__cause__
+    return False
+
+
+def _is_upstream_error(error: BaseException) -> bool:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        # httpx.HTTPStatusError guarda o status na resposta
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return is_upstream_status(status)
+    # Os SDKs só são consultados se já foram importados (quem levantou o erro importou)
+    openai = sys.modules.get("openai")
+    if openai is not None and isinstance(error, openai.APIConnectionError):
+        return True
+    httpx = sys.modules.get("httpx")
+    return httpx is not None and isinstance(error, httpx.TransportError)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker de um upstream (login, menu, categorias, embeddings, chat).
+
+    Fechado: chamadas passam; `failure_threshold` falhas seguidas abrem o circuito.
+    Aberto: chamadas falham na hora com `CircuitOpen` durante `reset_timeout`.
+    Meio-aberto: passado o prazo, UMA chamada de teste passa; sucesso fecha, falha reabre.
+    Só erros do upstream contam (`is_upstream_error`). O `guard` deve envolver só a chamada de rede,
+    dentro do `wait_for` do orçamento: prazo estourado vira cancelamento, que não conta.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        metrics.set_gauge("menux_circuit_state", _STATE_VALUE[CLOSED], upstream=name)
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        self.state = state
+        metrics.set_gauge("menux_circuit_state", _STATE_VALUE[state], upstream=self.name)
+        metrics.inc("menux_circuit_transitions_total", upstream=self.name, state=state)
+        print(f"⚡ Circuito {self.name}: {state}")
+
+    def is_open(self) -> bool:
+        """Aberto e ainda dentro do prazo (sem consumir a chamada de teste do meio-aberto)."""
+        return self.state == OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def _allow(self) -> bool:
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._trial_in_flight = False
+        self._transition(CLOSED)
+
+    def record_failure(self):
+        self._trial_in_flight = False
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._transition(OPEN)
+
+    @asynccontextmanager
+    async def guard(self):
+        """Envolve uma chamada ao upstream. Levanta `CircuitOpen` sem chamar se o circuito estiver aberto."""
+        if not self._allow():
+            metrics.inc("menux_circuit_rejected_total", upstream=self.name)
+            raise CircuitOpen(self.name)
+        try:
+            yield
+        except BaseException as e:
+            if isinstance(e, Exception) and is_upstream_error(e):
+                self.record_failure()
+            else:
+                # Cancelado (prazo/cliente) ou erro nosso: não diz nada do upstream, só libera a chamada de teste
+                self._trial_in_flight = False
+            raise
+        else:
+            self.record_success()
+
+
+# Um breaker por upstream (instâncias únicas do processo)
+login_circuit = CircuitBreaker("login")
+menu_items_circuit = CircuitBreaker("menu_items")
+categories_circuit = CircuitBreaker("categories")
+embeddings_circuit = CircuitBreaker("embeddings")
+chat_circuit = CircuitBreaker("chat")
+
+circuits: Dict[str, CircuitBreaker] = {
+    c.name: c for c in (login_circuit, menu_items_circuit, categories_circuit, embeddings_circuit, chat_circuit)
+}
@@ -0,0 +1,103 @@
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+
+def _float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+def _int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Configuração do processo, lida UMA vez do ambiente (.env incluso) em `get_settings()`."""
+
+    # Credenciais e serviços externos
+    openai_api_key: Optional[str]
+    api_base_url: str
+    auth_email: Optional[str]
+    auth_password: Optional[str]
+    redis_url: str
+    admin_token: str
+
+    # Controle de admissão (chamadas OpenAI)
+    llm_max_concurrency: int
+    llm_max_concurrency_per_restaurant: int
+    llm_queue_max: int
+    llm_queue_max_per_restaurant: int
+    llm_queue_timeout: float
+
+    # Orçamento de latência por requisição e tetos por estágio (segundos)
+    request_budget_seconds: float
+    embedding_timeout: float
+    menu_fetch_timeout: float
+    menu_load_timeout: float
+    rerank_timeout: float
+    rerank_reserve_seconds: float
+    agent_request_timeout: float
+
+    # Circuit breakers por upstream (falhas seguidas para abrir, segundos aberto antes de testar)
+    circuit_failure_threshold: int
+    circuit_reset_seconds: float
+
+    # Micro-batching de embeddings
+    embedding_batch_window_ms: float
+    embedding_batch_max_size: int
+    embedding_batch_max_in_flight: int
+
+    # Cursor de candidatos por sessão ("outra opção")
+    session_cursor_ttl_seconds: float
+    session_cursor_max_sessions: int
+
+    # Profiling opt-in
+    profile_sample_rate: float
+    profile_slow_ms: float
+    profile_interval_ms: float
+    profile_buffer_size: int
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        return cls(
+            openai_api_key=os.getenv("OPENAI_API_KEY"),
+            api_base_url=os.getenv("API_BASE_URL", "http://localhost:3000/api/v1"),
+            auth_email=os.getenv("AUTH_EMAIL"),
+            auth_password=os.getenv("AUTH_PASSWORD"),
+            redis_url=os.getenv("REDIS_URL", "redis://localhost:6379"),
+            admin_token=os.getenv("ADMIN_TOKEN", ""),
+            llm_max_concurrency=_int("LLM_MAX_CONCURRENCY", 32),
+            llm_max_concurrency_per_restaurant=_int("LLM_MAX_CONCURRENCY_PER_RESTAURANT", 8),
+            llm_queue_max=_int("LLM_QUEUE_MAX", 64),
+            llm_queue_max_per_restaurant=_int("LLM_QUEUE_MAX_PER_RESTAURANT", 16),
+            llm_queue_timeout=_float("LLM_QUEUE_TIMEOUT", 2.0),
+            request_budget_seconds=_float("REQUEST_BUDGET_SECONDS", 6.0),
+            embedding_timeout=_float("EMBEDDING_TIMEOUT", 1.5),
+            menu_fetch_timeout=_float("MENU_FETCH_TIMEOUT", 5.0),
+            menu_load_timeout=_float("MENU_LOAD_TIMEOUT", 10.0),
+            rerank_timeout=_float("RERANK_TIMEOUT", 3.0),
+            rerank_reserve_seconds=_float("RERANK_RESERVE_SECONDS", 1.5),
+            agent_request_timeout=_float("AGENT_REQUEST_TIMEOUT", 4.0),
+            circuit_failure_threshold=_int("CIRCUIT_FAILURE_THRESHOLD", 5),
+            circuit_reset_seconds=_float("CIRCUIT_RESET_SECONDS", 30),
+            embedding_batch_window_ms=_float("EMBEDDING_BATCH_WINDOW_MS", 5),
+            embedding_batch_max_size=_int("EMBEDDING_BATCH_MAX_SIZE", 64),
+            embedding_batch_max_in_flight=_int("EMBEDDING_BATCH_MAX_IN_FLIGHT", 4),
+            session_cursor_ttl_seconds=_float("SESSION_CURSOR_TTL_SECONDS", 900),
+            session_cursor_max_sessions=_int("SESSION_CURSOR_MAX_SESSIONS", 5000),
+            profile_sample_rate=_float("PROFILE_SAMPLE_RATE", 0),
+            profile_slow_ms=_float("PROFILE_SLOW_MS", 1500),
+            profile_interval_ms=_float("PROFILE_INTERVAL_MS", 5),
+            profile_buffer_size=_int("PROFILE_BUFFER_SIZE", 50),
+        )
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Carrega o .env (uma vez só no processo) e devolve as configurações tipadas."""
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    return Settings.from_env()
@@ -0,0 +1,73 @@
+import time
+from contextvars import ContextVar
+from typing import List, Optional
+
+from . import metrics
+from .config import get_settings
+
+_settings = get_settings()
+
+# Orçamento total de latência de um /chat (segundos).
+# Preferimos uma recomendação um pouco pior em 2s do que a perfeita em 15s.
+REQUEST_BUDGET_SECONDS = _settings.request_budget_seconds
+# Tetos por estágio (valem mesmo fora de um /chat)
+EMBEDDING_TIMEOUT = _settings.embedding_timeout
+MENU_FETCH_TIMEOUT = _settings.menu_fetch_timeout
+# Quanto uma requisição espera o primeiro carregamento do cardápio (que continua em background)
+MENU_LOAD_TIMEOUT = _settings.menu_load_timeout
+RERANK_TIMEOUT = _settings.rerank_timeout
+# Tempo guardado para o agente escrever a resposta final depois da tool
+RERANK_RESERVE_SECONDS = _settings.rerank_reserve_seconds
+# Abaixo disso nem vale a pena chamar o reranker
+MIN_RERANK_BUDGET = 0.3
+# Timeout de CADA ida do agente ao LLM, abaixo do orçamento: um upstream travado estoura no SDK
+# (e conta no circuit breaker) antes de o prazo da requisição cortar a execução
+AGENT_REQUEST_TIMEOUT = _settings.agent_request_timeout
+# Folga do wait_for do orçamento sobre o timeout do cliente HTTP/SDK (ver `budget_wait`)
+CLIENT_TIMEOUT_GRACE = 0.25
+
+metrics.describe("menux_fallback_total", "Fallbacks acionados por estágio (prazo estourado, erro, etc).")
+
+
+class Deadline:
+    """Prazo de uma requisição, carregado por todos os estágios via `current_deadline`."""
+
+    def __init__(self, budget: float = REQUEST_BUDGET_SECONDS):
+        self.budget = budget
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + budget
+        self.fallbacks: List[str] = []
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+
+current_deadline: ContextVar[Optional[Deadline]] = ContextVar("current_deadline", default=None)
+
+
+def time_left(limit: float, reserve: float = 0.0) -> float:
+    """Tempo disponível para um estágio: `limit` capado pelo orçamento da requisição (menos `reserve`)."""
+    deadline = current_deadline.get()
+    if deadline is None:
+        return limit
+    return max(0.0, min(limit, deadline.remaining() - reserve))
+
+
+def budget_wait(timeout: float, limit: float) -> float:
+    """
+    Prazo do `wait_for` do orçamento em volta de uma chamada cujo cliente HTTP/SDK usa `limit` como timeout.
+    Se o orçamento não apertou (`timeout` == `limit`), o cliente estoura primeiro e isso conta como falha
+    do upstream no circuit breaker. Se apertou, o corte do orçamento é cancelamento e não conta.
+    """
+    return timeout if timeout < limit else limit + CLIENT_TIMEOUT_GRACE
+
+
+def record_fallback(stage: str):
+    """Registra um fallback na métrica e nos metadados da resposta atual."""
+    metrics.inc("menux_fallback_total", stage=stage)
+    deadline = current_deadline.get()
+    if deadline is not None:
+        deadline.fallbacks.append(stage)
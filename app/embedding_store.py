@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+import numpy as np
+
+from . import metrics
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+metrics.describe("menux_embedding_store_entries", "Vetores únicos residentes no store de embeddings.")
+metrics.describe("menux_embedding_store_lookups_total", "Textos pedidos ao store (hit = já existia, miss = foi para a OpenAI).")
+
+
+def content_key(text: str, model: str = EMBEDDING_MODEL) -> str:
+    """Endereço do vetor: hash do texto de embedding + modelo."""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Normaliza (L2) as linhas para que o produto escalar seja a similaridade de cosseno."""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class EmbeddingStore:
+    """
+    Store de embeddings endereçado por conteúdo, compartilhado entre restaurantes.
+
+    Redes/franquias com cardápios quase iguais ("Coca-Cola 350ml ... Categoria: Bebidas")
+    geram o mesmo texto de embedding em várias unidades. Aqui cada texto único vira UMA
+    linha em uma matriz única (`vectors`, já normalizada); os restaurantes guardam só os
+    índices das linhas. Só textos nunca vistos vão para a OpenAI, e a contagem de
+    referências libera a linha quando nenhum cardápio usa mais aquele texto.
+    """
+
+    def __init__(self, model: str = EMBEDDING_MODEL, initial_capacity: int = 1024):
+        self.model = model
+        self.vectors: Optional[np.ndarray] = None
+        self._initial_capacity = initial_capacity
+        self._row_by_key: Dict[str, int] = {}
+        self._key_by_row: Dict[int, str] = {}
+        self._refs: Dict[int, int] = {}
+        self._free: List[int] = []
+        self._next_row = 0
+        # Textos sendo vetorizados agora (refreshs concorrentes esperam o mesmo resultado)
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._row_by_key)
+
+    def _alloc_row(self, dim: int) -> int:
+        if self.vectors is None:
+            self.vectors = np.zeros((self._initial_capacity, dim), dtype=np.float32)
+        if self._free:
+            return self._free.pop()
+        if self._next_row >= len(self.vectors):
+            # Cresce dobrando; as linhas existentes mantêm o mesmo índice
+            grown = np.zeros((len(self.vectors) * 2, self.vectors.shape[1]), dtype=np.float32)
+            grown[:len(self.vectors)] = self.vectors
+            self.vectors = grown
+        row = self._next_row
+        self._next_row += 1
+        return row
+
+    def _insert(self, key: str, vector: List[float]) -> int:
+        vec = normalize_rows(np.asarray(vector, dtype=np.float32))
+        row = self._alloc_row(len(vec))
+        self.vectors[row] = vec
+        self._row_by_key[key] = row
+        self._key_by_row[row] = key
+        self._refs[row] = 0
+        return row
+
+    async def acquire(
+        self,
+        texts: List[str],
+        embed_fn: Callable[[List[str]], Awaitable[List[List[float]]]],
+    ) -> Optional[np.ndarray]:
+        """
+        Garante um vetor para cada texto e incrementa as referências.
+        Retorna as linhas em `vectors` (mesma ordem de `texts`), ou None se a OpenAI falhar.
+        """
+        keys = [content_key(text, self.model) for text in texts]
+
+        # Textos únicos que ninguém tem nem está buscando
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in self._row_by_key and key not in self._pending:
+                missing[key] = text
+        waiting = {key: self._pending[key] for key in set(keys) if key in self._pending}
+
+        metrics.inc("menux_embedding_store_lookups_total", len(texts) - len(missing), result="hit")
+        metrics.inc("menux_embedding_store_lookups_total", len(missing), result="miss")
+
+        if missing:
+            loop = asyncio.get_running_loop()
+            futures = {key: loop.create_future() for key in missing}
+            self._pending.update(futures)
+            try:
+                vectors = await embed_fn(list(missing.values()))
+                if len(vectors) != len(missing):
+                    raise RuntimeError("Falha ao gerar embeddings")
+                for key, vector in zip(missing, vectors):
+                    self._insert(key, vector)
+                    futures[key].set_result(True)
+            except Exception as e:
+                print(f"Erro no store de embeddings: {e}")
+                self._fail(futures, e)
+                return None
+            except BaseException:
+                # Cancelado no meio: quem esperava estes textos também desiste
+                self._fail(futures, RuntimeError("Embedding cancelado"))
+                raise
+            finally:
+                for key in missing:
+                    self._pending.pop(key, None)
+
+        if waiting:
+            try:
+                await asyncio.gather(*waiting.values())
+            except BaseException as e:
+                # Os textos que acabamos de inserir ainda não têm referência: libera antes de desistir
+                self._drop_unreferenced(missing)
+                if isinstance(e, Exception):
+                    return None
+                raise
+
+        # Algum texto pode ter sido liberado enquanto esperávamos: tenta de novo
+        if any(key not in self._row_by_key for key in keys):
+            return await self.acquire(texts, embed_fn)
+
+        # Todos os textos existem agora: conta referências (uma por ocorrência)
+        rows = np.array([self._row_by_key[key] for key in keys], dtype=np.int64)
+        for row in rows:
+            self._refs[int(row)] += 1
+        metrics.set_gauge("menux_embedding_store_entries", len(self))
+        return rows
+
+    def _drop_unreferenced(self, keys: Iterable[str]):
+        for key in keys:
+            row = self._row_by_key.get(key)
+            if row is not None and self._refs.get(row) == 0:
+                self.release([row])
+
+    @staticmethod
+    def _fail(futures: Dict[str, asyncio.Future], error: Exception):
+        for fut in futures.values():
+            if not fut.done():
+                fut.set_exception(error)
+                fut.exception()  # marca como lida (pode não haver ninguém esperando)
+
+    def release(self, rows: np.ndarray):
+        """Devolve referências; linhas sem nenhuma referência são liberadas para reuso."""
+        for row in rows:
+            row = int(row)
+            if row not in self._refs:
+                continue
+            self._refs[row] -= 1
+            if self._refs[row] <= 0:
+                del self._refs[row]
+                del self._row_by_key[self._key_by_row.pop(row)]
+                self._free.append(row)
+        metrics.set_gauge("menux_embedding_store_entries", len(self))
+
+
+# Instância única do processo, compartilhada por todos os restaurantes
+embedding_store = EmbeddingStore()
@@ -0,0 +1,192 @@
+import re
+import unicodedata
+from typing import Dict, List, Any, Optional, Set, Tuple, TYPE_CHECKING
+import numpy as np
+
+if TYPE_CHECKING:
+    from .menu_index import MenuIndex
+    from .models import SuggestionRequest
+
+# Regras de restrição alimentar.
+# chave: (gatilhos no texto de `restricoes`, tags que tornam o item seguro, tags que o tornam proibido)
+# Tudo já normalizado (minúsculo e sem acento). O match com as tags do item é por substring,
+# então "sem gluten" também casa com "100% sem gluten".
+RESTRICTION_RULES: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[str, ...]]] = {
+    "gluten": (("gluten", "celiac"), ("sem gluten", "gluten free", "zero gluten"), ("contem gluten",)),
+    "lactose": (("lactose", "laticinio", "leite"), ("sem lactose", "zero lactose", "lactose free"), ("contem lactose",)),
+    "vegano": (("vegan",), ("vegan",), ()),
+    "vegetariano": (("vegetarian",), ("vegetarian", "vegan"), ()),
+    "acucar": (("acucar", "diabet"), ("sem acucar", "zero acucar", "diet"), ()),
+}
+
+# Bônus de score para itens cujas tags batem com `preferencias` (soft, não elimina ninguém)
+PREFERENCE_BOOST = 0.05
+
+# Campos de disponibilidade que a API de menu pode mandar (ausente = disponível)
+AVAILABILITY_KEYS = ("available", "isAvailable", "active", "isActive")
+
+# Palavras que não carregam intenção de busca. Se a mensagem só tiver isso
+# (saudação, "o que tem no cardápio?"), não há intenção de busca.
+_NOISE_WORDS = {
+    # saudações / conversa
+    "oi", "ola", "opa", "hello", "hi", "bom", "boa", "dia", "tarde", "noite", "tudo", "bem",
+    "obrigado", "obrigada", "valeu", "tchau", "ok", "beleza", "blz", "ai", "sim", "nao",
+    # pedidos vagos
+    "cardapio", "menu", "opcoes", "tem", "vcs", "voces", "aqui", "ver", "mostra", "mostrar",
+    # pedidos de "outra opção" (a intenção é a da busca anterior)
+    "outra", "outro", "outras", "outros", "opcao", "mais", "diferente", "alternativa",
+    # stopwords / verbos de pedido
+    "quero", "queria", "gostaria", "vou", "pode", "me", "eu", "um", "uma", "uns", "umas",
+    "o", "a", "os", "as", "de", "do", "da", "dos", "das", "no", "na", "nos", "nas", "com", "sem", "para", "pra", "por",
+    "e", "ou", "que", "qual", "quais", "algo", "alguma", "algum", "coisa", "comer", "beber",
+    "tomar", "pedir", "hoje", "agora", "favor", "sugere", "sugira", "sugestao", "indica",
+}
+
+# "até R$ 49,90", "no máximo R$ 80", "menos de 60 reais", "até 50 reais", "max R$ 1.234,56".
+# Exige palavra inteira E contexto de moeda: "chocolate 70%" ou "até 3 fatias" não viram teto de preço.
+# Valor com separador de milhar ("1.200", "1.234,56") vem antes do decimal simples ("49.90", "49,90").
+_THOUSANDS_RE = re.compile(r"\d{1,3}(?:\.\d{3})+(?:,\d{1,2})?")
+_PRICE_NUMBER = rf"(?:{_THOUSANDS_RE.pattern}|\d+(?:[.,]\d{{1,2}})?)"
+_PRICE_LIMIT_RE = re.compile(
+    rf"\b(?:ate|maximo|max|menos de)\s+(?:r\$\s*({_PRICE_NUMBER})\b|({_PRICE_NUMBER})\s*reais?\b)"
+)
+
+
+def normalize_text(text: str) -> str:
+    """Minúsculo e sem acentos, para comparar tags e restrições sem depender de grafia."""
+    text = unicodedata.normalize("NFKD", str(text or ""))
+    return "".join(c for c in text if not unicodedata.combining(c)).lower().strip()
+
+
+def content_tokens(text: str) -> Set[str]:
+    """Termos de busca do texto (normalizados, sem saudações e stopwords)."""
+    words = re.split(r"[^\w]+", normalize_text(text))
+    return {w for w in words if w and w not in _NOISE_WORDS}
+
+
+def lexical_terms(text: str) -> Set[str]:
+    """Termos para a busca lexical (fallback sem embeddings): `content_tokens` com plural simples removido."""
+    return {w[:-1] if len(w) > 3 and w.endswith("s") else w for w in content_tokens(text)}
+
+
+def token_overlap(a: Set[str], b: Set[str]) -> float:
+    """Similaridade de Jaccard entre dois conjuntos de termos (0 se algum for vazio)."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def parse_price(value: Any) -> float:
+    """Converte o preço da API ("12.00", "R$ 12,90", 12.9) em float. NaN se não der."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = re.sub(r"[^\d.,]", "", str(value or ""))
+    if "," in text:
+        # Formato brasileiro: "1.234,56"
+        text = text.replace(".", "").replace(",", ".")
+    try:
+        return float(text)
+    except ValueError:
+        return float("nan")
+
+
+def is_available(item: Dict[str, Any]) -> bool:
+    return all(item.get(key, True) is not False for key in AVAILABILITY_KEYS)
+
+
+def build_tag_bitmap(items: List[Dict[str, Any]]) -> Tuple[Dict[str, int], np.ndarray]:
+    """Vocabulário de tags normalizadas + bitmap (itens x tags)."""
+    vocab: Dict[str, int] = {}
+    item_tags = []
+    for item in items:
+        tags = {normalize_text(tag) for tag in (item.get("tags") or []) if tag}
+        for tag in tags:
+            vocab.setdefault(tag, len(vocab))
+        item_tags.append(tags)
+
+    bitmap = np.zeros((len(items), len(vocab)), dtype=bool)
+    for row, tags in enumerate(item_tags):
+        bitmap[row, [vocab[tag] for tag in tags]] = True
+    return vocab, bitmap
+
+
+def _tags_mask(vocab: Dict[str, int], bitmap: np.ndarray, patterns: Tuple[str, ...]) -> np.ndarray:
+    cols = [col for tag, col in vocab.items() if any(p in tag for p in patterns)]
+    if not cols:
+        return np.zeros(bitmap.shape[0], dtype=bool)
+    return bitmap[:, cols].any(axis=1)
+
+
+def build_restriction_masks(vocab: Dict[str, int], bitmap: np.ndarray) -> Dict[str, Tuple[Optional[np.ndarray], np.ndarray]]:
+    """
+    Pré-computa, por regra, (máscara de itens seguros, máscara de itens proibidos).
+    A máscara de seguros é None quando nenhum item do cardápio usa a tag: nesse caso
+    não dá para garantir nada estruturalmente e só os proibidos explícitos saem.
+    """
+    masks = {}
+    for rule, (_, safe_tags, forbidden_tags) in RESTRICTION_RULES.items():
+        safe = _tags_mask(vocab, bitmap, safe_tags)
+        forbidden = _tags_mask(vocab, bitmap, forbidden_tags) if forbidden_tags else np.zeros(bitmap.shape[0], dtype=bool)
+        masks[rule] = (safe if safe.any() else None, forbidden)
+    return masks
+
+
+def parse_restrictions(text: Optional[str]) -> List[str]:
+    """Quais regras de RESTRICTION_RULES o texto livre de `restricoes` aciona."""
+    norm = normalize_text(text or "")
+    if not norm:
+        return []
+    return [rule for rule, (triggers, _, _) in RESTRICTION_RULES.items() if any(t in norm for t in triggers)]
+
+
+def parse_price_limit(*texts: Optional[str]) -> Optional[float]:
+    """Extrai um teto de preço de textos livres ("até R$ 50"), se houver."""
+    for text in texts:
+        match = _PRICE_LIMIT_RE.search(normalize_text(text or ""))
+        if match:
+            return _parse_limit_number(match.group(1) or match.group(2))
+    return None
+
+
+def _parse_limit_number(text: str) -> float:
+    # Texto do usuário: ponto só é decimal sem o formato de milhar ("49.90"); "1.200" é mil e duzentos
+    if _THOUSANDS_RE.fullmatch(text):
+        text = text.replace(".", "")
+    return float(text.replace(",", "."))
+
+
+def build_filter_mask(index: "MenuIndex", req: Optional["SuggestionRequest"]) -> np.ndarray:
+    """
+    Combina disponibilidade, restrições e teto de preço em uma máscara booleana (1 por item).
+    Tudo vem de colunas/bitmaps montados no refresh, então isso é só AND de arrays.
+    """
+    mask = index.available.copy()
+    if req is None:
+        return mask
+
+    for rule in parse_restrictions(req.restricoes):
+        safe, forbidden = index.restriction_masks[rule]
+        if safe is not None:
+            mask &= safe
+        mask &= ~forbidden
+
+    max_price = req.preco_maximo
+    if max_price is None:
+        max_price = parse_price_limit(req.preferencias, req.restricoes)
+    if max_price is not None:
+        # Preço desconhecido (NaN) não passa pelo teto
+        mask &= index.prices <= max_price
+
+    return mask
+
+
+def preference_boost(index: "MenuIndex", req: Optional["SuggestionRequest"]) -> Optional[np.ndarray]:
+    """Bônus por item para tags citadas em `preferencias` (None se nada casar)."""
+    if req is None or not req.preferencias or not index.tag_vocab:
+        return None
+
+    words = [w for w in re.split(r"[^\w]+", normalize_text(req.preferencias)) if len(w) >= 3]
+    cols = [col for tag, col in index.tag_vocab.items() if any(w in tag for w in words)]
+    if not cols:
+        return None
+    return index.tag_matrix[:, cols].any(axis=1) * np.float32(PREFERENCE_BOOST)
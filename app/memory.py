@@ -1,20 +1,67 @@
 import json
-import os
+import dataclasses
 import redis.asyncio as redis
-from typing import List, Optional
-from pydantic_ai import ModelMessage
+from functools import lru_cache
+from typing import Any, List, Optional, TYPE_CHECKING
 from pydantic import TypeAdapter
 
-# Adapter para serializar/deserializar lista de mensagens do PydanticAI
-msg_list_adapter = TypeAdapter(List[ModelMessage])
+from . import metrics
+from .config import get_settings
+
+if TYPE_CHECKING:
+    from pydantic_ai import ModelMessage
+
+@lru_cache(maxsize=1)
+def msg_list_adapter() -> TypeAdapter:
+    """Adapter para serializar/deserializar lista de mensagens do PydanticAI (montado no primeiro uso)."""
+    from pydantic_ai import ModelMessage
+    return TypeAdapter(List[ModelMessage])
+
+# Tools de busca: o retorno (SuggestionResult) vai para o histórico só com id, nome e preço.
+# Descrição e categoria voltam sob demanda pela tool `detalhar_itens` (cache do cardápio).
+COMPACT_TOOL_RETURNS = ("consultar_cardapio", "surpreenda_me")
+COMPACT_ITEM_FIELDS = ("id", "nome", "preco")
+
+metrics.describe("menux_history_bytes", "Tamanho do histórico salvo no Redis por sessão.")
+
+def _compact_suggestions(content: Any) -> Any:
+    data = content.model_dump() if hasattr(content, "model_dump") else content
+    if not isinstance(data, dict) or not isinstance(data.get("sugestoes"), list):
+        return content
+    return {
+        "sugestoes": [
+            {field: item.get(field) for field in COMPACT_ITEM_FIELDS}
+            for item in data["sugestoes"]
+            if isinstance(item, dict)
+        ]
+    }
+
+def compact_tool_returns(messages: List["ModelMessage"]) -> List["ModelMessage"]:
+    """Reescreve os retornos das tools de busca para a forma compacta (não altera as mensagens originais)."""
+    from pydantic_ai.messages import ModelRequest, ToolReturnPart
+
+    compacted = []
+    for msg in messages:
+        if isinstance(msg, ModelRequest) and any(
+            isinstance(p, ToolReturnPart) and p.tool_name in COMPACT_TOOL_RETURNS for p in msg.parts
+        ):
+            parts = [
+                dataclasses.replace(p, content=_compact_suggestions(p.content))
+                if isinstance(p, ToolReturnPart) and p.tool_name in COMPACT_TOOL_RETURNS
+                else p
+                for p in msg.parts
+            ]
+            msg = dataclasses.replace(msg, parts=parts)
+        compacted.append(msg)
+    return compacted
 
 class RedisMemory:
     def __init__(self, redis_url: Optional[str] = None):
-        self.redis_url = redis_url or os.getenv("REDIS_URL", "redis://localhost:6379")
+        self.redis_url = redis_url or get_settings().redis_url
         self.client = redis.from_url(self.redis_url, decode_responses=True)
         self.ttl = 86400  # 24 horas de expiração
 
-    async def get_history(self, session_id: str) -> List[ModelMessage]:
+    async def get_history(self, session_id: str) -> List["ModelMessage"]:
         """Recupera histórico da sessão do Redis."""
         key = f"menux:chat:{session_id}"
         data = await self.client.get(key)
@@ -23,7 +70,7 @@ class RedisMemory:
         
         try:
             # Reconstrói objetos Pydantic a partir do JSON
-            messages = msg_list_adapter.validate_json(data)
+            messages = msg_list_adapter().validate_json(data)
             
             # Validação de integridade do histórico (recuperação de erros antigos)
             # Se a primeira mensagem for um ToolReturn sem um ToolCall antes (histórico quebrado legado)
@@ -42,7 +89,7 @@ class RedisMemory:
             print(f"Erro ao deserializar histórico: {e}")
             return []
 
-    async def save_history(self, session_id: str, new_messages: List[ModelMessage]):
+    async def save_history(self, session_id: str, new_messages: List["ModelMessage"]):
         """
         Adiciona novas mensagens e trunca para manter apenas as últimas 8.
         NOTA: A lógica aqui carrega tudo, anexa e salva. 
@@ -55,8 +102,8 @@ class RedisMemory:
         # 1. Carrega atual
         current_history = await self.get_history(session_id)
         
-        # 2. Anexa novos
-        updated_history = current_history + new_messages
+        # 2. Anexa novos (retornos das tools de busca já compactados)
+        updated_history = current_history + compact_tool_returns(new_messages)
         
         # 3. Trunca (Mantém as últimas 8 mensagens de forma segura)
         # Se cortarmos cegamente os últimos N, podemos separar um ToolReturn de um ToolCall,
@@ -79,7 +126,8 @@ class RedisMemory:
             updated_history = updated_history[safe_idx:]
             
         # 4. Salva com TTL
-        json_data = msg_list_adapter.dump_json(updated_history)
+        json_data = msg_list_adapter().dump_json(updated_history)
+        metrics.observe("menux_history_bytes", len(json_data), buckets=(1024, 2048, 4096, 8192, 16384, 32768, 65536))
         await self.client.set(key, json_data, ex=self.ttl)
         
     async def clear_history(self, session_id: str):
@@ -0,0 +1,158 @@
+from typing import Dict, List, Any, Iterable, Optional, Set
+import numpy as np
+from .models import CategoriaProduto
+from .embedding_store import EmbeddingStore, normalize_rows
+from .filters import parse_price, is_available, build_tag_bitmap, build_restriction_masks, lexical_terms
+
+# Categorias "de produto" que o agente conhece (TODAS não é um foco real)
+FOCUS_CATEGORIES = [c for c in CategoriaProduto if c != CategoriaProduto.TODAS]
+
+# Uma categoria do restaurante entra no foco se o seu centróide estiver a no máximo
+# esta distância (em similaridade) da categoria mais parecida com o foco.
+# Ex: VINHOS -> {"Vinhos Tintos", "Vinhos Brancos"} e não só a melhor delas.
+FOCUS_SIMILARITY_MARGIN = 0.05
+
+# Se o subconjunto do foco tiver menos itens que isso, buscamos no cardápio inteiro
+# (melhor um candidato "fora" da categoria do que nenhum candidato).
+MIN_FOCUS_CANDIDATES = 5
+
+
+def focus_embedding_text(focus: CategoriaProduto) -> str:
+    """Texto vetorizado para um foco. Segue o formato 'Categoria: X' usado nos itens."""
+    return f"Categoria: {focus.value.replace('_', ' ')}"
+
+
+class MenuIndex:
+    """
+    Índice vetorial de um restaurante, montado no refresh do cardápio.
+
+    Guarda a matriz de embeddings normalizada (1 linha por item), as linhas de cada
+    categoria do restaurante e, para cada valor de `CategoriaProduto`, o embedding
+    pré-computado do foco e as categorias do restaurante que casam com ele.
+    Assim a busca pontua só o subconjunto da categoria e o "surpreenda-me" não
+    precisa gerar embedding do foco a cada chamada.
+
+    Os vetores em si moram no `EmbeddingStore` compartilhado (endereçado por conteúdo);
+    o índice guarda só as linhas do store (`store_rows`, 1 por item).
+    """
+
+    def __init__(
+        self,
+        items: List[Dict[str, Any]],
+        store: EmbeddingStore,
+        store_rows: np.ndarray,
+        focus_vectors: Dict[CategoriaProduto, List[float]],
+    ):
+        self.items = items
+        self.ids = [item["id"] for item in items]
+        self.row_by_id = {item_id: row for row, item_id in enumerate(self.ids)}
+        self.store = store
+        self.store_rows = store_rows
+        self.all_rows = np.arange(len(items))
+
+        # Colunas estruturadas para o motor de filtros (preço, disponibilidade, tags)
+        self.prices = np.array([parse_price(item.get("price")) for item in items], dtype=np.float32)
+        self.available = np.array([is_available(item) for item in items], dtype=bool)
+        self.tag_vocab, self.tag_matrix = build_tag_bitmap(items)
+        self.restriction_masks = build_restriction_masks(self.tag_vocab, self.tag_matrix)
+
+        # Termos de cada item para a busca lexical (quando os embeddings estão fora)
+        self.lexical_terms: List[Set[str]] = [
+            lexical_terms(
+                f"{item.get('name', '')} {item.get('description') or ''} "
+                f"{(item.get('category') or {}).get('name', '')} {' '.join(item.get('tags') or [])}"
+            )
+            for item in items
+        ]
+
+        # Linhas de cada categoria do restaurante + centróide (média normalizada)
+        rows_by_category: Dict[str, List[int]] = {}
+        for row, item in enumerate(items):
+            cat_name = (item.get("category") or {}).get("name") or "Outros"
+            rows_by_category.setdefault(cat_name, []).append(row)
+
+        self.category_rows: Dict[str, np.ndarray] = {
+            name: np.asarray(rows) for name, rows in rows_by_category.items()
+        }
+        self.centroids: Dict[str, np.ndarray] = {
+            name: normalize_rows(self.store.vectors[self.store_rows[rows]].mean(axis=0))
+            for name, rows in self.category_rows.items()
+        }
+
+        self.focus_vectors: Dict[CategoriaProduto, np.ndarray] = {
+            focus: normalize_rows(np.asarray(vec, dtype=np.float32))
+            for focus, vec in focus_vectors.items()
+        }
+        self.focus_categories: Dict[CategoriaProduto, Set[str]] = {}
+        self.focus_rows: Dict[CategoriaProduto, np.ndarray] = {}
+        self._resolve_focus()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """Matriz normalizada (itens x dim) montada do store. É uma cópia: prefira `score`."""
+        return self.store.vectors[self.store_rows]
+
+    def _resolve_focus(self):
+        """Resolve, por similaridade foco x centróide, quais categorias pertencem a cada foco."""
+        if not self.centroids:
+            return
+
+        names = list(self.centroids)
+        centroid_matrix = np.stack([self.centroids[name] for name in names])
+
+        for focus, vec in self.focus_vectors.items():
+            sims = centroid_matrix @ vec
+            best = float(sims.max())
+            matched = {names[i] for i, sim in enumerate(sims) if sim >= best - FOCUS_SIMILARITY_MARGIN}
+
+            # Match textual óbvio também conta ("Vinhos da Casa" para VINHOS)
+            stem = focus.value.replace("_", " ").rstrip("s")
+            matched |= {name for name in names if stem in name.lower()}
+
+            self.focus_categories[focus] = matched
+            self.focus_rows[focus] = np.sort(np.concatenate([self.category_rows[name] for name in matched]))
+
+    def candidate_rows(
+        self,
+        focus: CategoriaProduto,
+        excluded_ids: Iterable[str] = (),
+        mask: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        Linhas que devem ser pontuadas para o foco pedido, já sem os itens excluídos
+        e sem os reprovados pela máscara de filtros estruturados (`filters.build_filter_mask`).
+        Cai para o cardápio inteiro se o subconjunto do foco for pequeno demais.
+        """
+        allowed = np.ones(len(self.ids), dtype=bool) if mask is None else mask.copy()
+        allowed[[self.row_by_id[i] for i in excluded_ids if i in self.row_by_id]] = False
+        all_rows = np.flatnonzero(allowed)
+
+        if focus == CategoriaProduto.TODAS or focus not in self.focus_rows:
+            return all_rows
+
+        rows = self.focus_rows[focus]
+        rows = rows[allowed[rows]]
+        if len(rows) < MIN_FOCUS_CANDIDATES:
+            return all_rows
+        return rows
+
+    def score(self, query_vec: List[float], rows: np.ndarray) -> np.ndarray:
+        """Similaridade de cosseno entre a query e as linhas pedidas (mesma ordem de `rows`)."""
+        q = normalize_rows(np.asarray(query_vec, dtype=np.float32))
+        return self.store.vectors[self.store_rows[rows]] @ q
+
+    def lexical_score(self, query_terms: Set[str], rows: np.ndarray) -> np.ndarray:
+        """Fração dos termos da query presentes em cada item (mesma ordem de `rows`)."""
+        if not query_terms:
+            return np.zeros(len(rows), dtype=np.float32)
+        return np.array(
+            [len(query_terms & self.lexical_terms[row]) / len(query_terms) for row in rows], dtype=np.float32
+        )
+
+    def score_many(self, query_vecs: List[List[float]]) -> np.ndarray:
+        """Similaridade de todos os itens com várias queries de uma vez: matriz (itens x queries)."""
+        q = normalize_rows(np.asarray(query_vecs, dtype=np.float32))
+        return self.matrix @ q.T
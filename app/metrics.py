@@ -0,0 +1,96 @@
+from typing import Dict, Tuple
+import threading
+
+# Registro de métricas em memória, exportado no formato texto do Prometheus em /metrics.
+# Sem dependência externa: contadores, gauges e histogramas com labels simples.
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+# Buckets padrão (segundos) para latências
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters: Dict[str, Dict[LabelKey, float]] = {}
+_gauges: Dict[str, Dict[LabelKey, float]] = {}
+_histograms: Dict[str, Dict[LabelKey, list]] = {}
+_histogram_buckets: Dict[str, Tuple[float, ...]] = {}
+_help: Dict[str, str] = {}
+
+
+def _key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def describe(name: str, text: str):
+    """Texto de ajuda (# HELP) da métrica."""
+    _help[name] = text
+
+
+def inc(name: str, value: float = 1.0, **labels):
+    with _lock:
+        series = _counters.setdefault(name, {})
+        key = _key(labels)
+        series[key] = series.get(key, 0.0) + value
+
+
+def set_gauge(name: str, value: float, **labels):
+    with _lock:
+        _gauges.setdefault(name, {})[_key(labels)] = value
+
+
+def remove_gauge(name: str, **labels):
+    """Remove uma série do gauge (ex.: fila de um restaurante que esvaziou)."""
+    with _lock:
+        _gauges.get(name, {}).pop(_key(labels), None)
+
+
+def observe(name: str, value: float, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **labels):
+    with _lock:
+        buckets = _histogram_buckets.setdefault(name, buckets)
+        series = _histograms.setdefault(name, {})
+        key = _key(labels)
+        # [contagem por bucket..., soma, total]
+        data = series.setdefault(key, [0] * len(buckets) + [0.0, 0])
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+
+
+def _escape_label(value: str) -> str:
+    # Formato texto do Prometheus: barra invertida, aspas e quebra de linha precisam de escape
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in pairs) + "}"
+
+
+def render() -> str:
+    """Exporta tudo no formato texto do Prometheus."""
+    lines = []
+    with _lock:
+        for kind, store in (("counter", _counters), ("gauge", _gauges)):
+            for name, series in store.items():
+                if name in _help:
+                    lines.append(f"# HELP {name} {_help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in series.items():
+                    lines.append(f"{name}{_fmt_labels(key)} {value}")
+
+        for name, series in _histograms.items():
+            buckets = _histogram_buckets[name]
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, data in series.items():
+                for bound, count in zip(buckets, data):
+                    lines.append(f"{name}_bucket{_fmt_labels(key, (('le', str(bound)),))} {count}")
+                lines.append(f"{name}_bucket{_fmt_labels(key, (('le', '+Inf'),))} {data[-1]}")
+                lines.append(f"{name}_sum{_fmt_labels(key)} {data[-2]}")
+                lines.append(f"{name}_count{_fmt_labels(key)} {data[-1]}")
+    return "\n".join(lines) + "\n"
@@ -1,12 +1,18 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from enum import Enum
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 @dataclass
 class MenuxDeps:
     categorias_str: str = ""
     restaurantId: str = ""
+    # Embedding especulativo da mensagem do usuário (app.speculation.SpeculativeEmbedding)
+    speculation: Optional[Any] = None
+    # Sessão do chat (cursor de candidatos para "outra opção")
+    session_id: str = ""
+    # Tasks das tools da execução atual do agente: run_id -> chamada (tool + argumentos) -> task
+    tool_cache: Dict[str, Any] = field(default_factory=dict)
 
 class CategoriaProduto(str, Enum):
     ENTRADAS = "entradas"
@@ -51,6 +57,7 @@ class SuggestionRequest(BaseModel):
     )
     preferencias: Optional[str] = Field(None, description="Preferências culinárias explícitas.")
     restricoes: Optional[str] = Field(None, description="Restrições alimentares (ex: glúten, lactose).")
+    preco_maximo: Optional[float] = Field(None, description="Preço máximo por item em reais, se o usuário mencionar um limite.")
     excluded_ids: List[str] = Field(
         default_factory=list,
         description="Lista de IDs (UUIDs) de itens que JÁ foram sugeridos e devem ser evitados nesta nova busca."
@@ -65,3 +72,14 @@ class MenuItem(BaseModel):
 
 class SuggestionResult(BaseModel):
     sugestoes: List[MenuItem]
+
+# --- Contrato da API (/chat) ---
+class ResponseMeta(BaseModel):
+    fallbacks: List[str] = Field(
+        default_factory=list,
+        description="Estágios que caíram em fallback nesta requisição (ex: rerank_timeout)."
+    )
+    elapsed_ms: int = Field(0, description="Tempo total de processamento da requisição.")
+
+class ChatResponse(MenuxResponse):
+    meta: Optional[ResponseMeta] = None
@@ -0,0 +1,163 @@
+import asyncio
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Dict, List, Optional
+
+from . import metrics
+from .config import get_settings
+
+_settings = get_settings()
+
+# Fração das requisições perfiladas (0 = desligado). Barato o bastante para deixar ~0.05 em produção.
+PROFILE_SAMPLE_RATE = _settings.profile_sample_rate
+# Só guardamos o perfil de requisições acima desse tempo
+PROFILE_SLOW_MS = _settings.profile_slow_ms
+# Intervalo entre amostras de stack e entre medições de lag do event loop
+PROFILE_INTERVAL_MS = _settings.profile_interval_ms
+# Quantos perfis lentos ficam no ring buffer
+PROFILE_BUFFER_SIZE = _settings.profile_buffer_size
+
+metrics.describe("menux_event_loop_lag_seconds", "Atraso do event loop medido durante requisições perfiladas.")
+
+
+def _collapse(frame) -> str:
+    """Stack no formato 'collapsed' (raiz;...;folha), uma entrada por função."""
+    names = []
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "?")
+        names.append(f"{module}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class ProfileSession:
+    """Amostras de uma requisição: stacks do thread do event loop + lag do loop."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.thread_id = threading.get_ident()
+        self.stacks: Counter = Counter()
+        self.lags: List[float] = []
+        self._lag_task: Optional[asyncio.Task] = None
+
+    async def _measure_lag(self, interval: float):
+        # Dorme `interval` e mede o quanto acordou atrasado: isso é tempo em que o loop ficou bloqueado
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag = time.perf_counter() - before - interval
+            self.lags.append(max(0.0, lag))
+
+    def start_lag_probe(self, interval: float):
+        self._lag_task = asyncio.create_task(self._measure_lag(interval))
+
+    def stop(self) -> float:
+        if self._lag_task:
+            self._lag_task.cancel()
+        for lag in self.lags:
+            metrics.observe("menux_event_loop_lag_seconds", lag)
+        return time.perf_counter() - self.start
+
+    def to_dict(self, elapsed: float) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "started_at": self.started_at,
+            "elapsed_ms": int(elapsed * 1000),
+            "samples": sum(self.stacks.values()),
+            "loop_lag_max_ms": round(max(self.lags, default=0.0) * 1000, 2),
+            "loop_lag_avg_ms": round(sum(self.lags) / len(self.lags) * 1000, 2) if self.lags else 0.0,
+            "collapsed": "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()),
+        }
+
+
+class SamplingProfiler:
+    """
+    Profiler estatístico: um único thread daemon lê `sys._current_frames()` a cada
+    intervalo, só enquanto houver requisição perfilada ativa. Cada amostra do thread
+    do event loop vai para todas as sessões ativas (o loop é compartilhado, então o
+    perfil mostra o que o processo fazia durante a requisição: scoring numpy,
+    json.dumps, validação Pydantic ou só esperando I/O no select).
+    """
+
+    def __init__(self, interval_ms: float = PROFILE_INTERVAL_MS, buffer_size: int = PROFILE_BUFFER_SIZE):
+        self.interval = interval_ms / 1000
+        self.slow_profiles: deque = deque(maxlen=buffer_size)
+        self._sessions: List[ProfileSession] = []
+        # Protege `_sessions` e acorda o thread quando entra a primeira sessão
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="menux-profiler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # Checagem e espera sob o mesmo lock: um begin() não se perde entre as duas
+                while not self._sessions:
+                    self._cond.wait()
+                sessions = list(self._sessions)
+            frames = sys._current_frames()
+            for session in sessions:
+                frame = frames.get(session.thread_id)
+                if frame is not None:
+                    session.stacks[_collapse(frame)] += 1
+            del frames
+            time.sleep(self.interval)
+
+    def begin(self, path: str) -> ProfileSession:
+        session = ProfileSession(path)
+        session.start_lag_probe(self.interval)
+        with self._cond:
+            self._sessions.append(session)
+            self._cond.notify()
+        self._ensure_thread()
+        return session
+
+    def end(self, session: ProfileSession, slow_ms: float = PROFILE_SLOW_MS):
+        with self._cond:
+            self._sessions.remove(session)
+        elapsed = session.stop()
+        if elapsed * 1000 >= slow_ms:
+            self.slow_profiles.append(session.to_dict(elapsed))
+
+    def collapsed(self) -> str:
+        """Todos os perfis lentos somados, no formato de entrada do flamegraph.pl / speedscope."""
+        total: Counter = Counter()
+        for profile in self.slow_profiles:
+            for line in profile["collapsed"].splitlines():
+                stack, _, count = line.rpartition(" ")
+                total[stack] += int(count)
+        return "\n".join(f"{stack} {count}" for stack, count in total.most_common())
+
+
+profiler = SamplingProfiler()
+
+
+class ProfilingMiddleware:
+    """
+    Middleware ASGI opt-in: perfila uma fração `PROFILE_SAMPLE_RATE` das requisições.
+    ASGI puro: a chamada só retorna depois do corpo inteiro (inclusive streaming, como o NDJSON
+    do /recommend/batch), e o `finally` encerra a sessão mesmo com erro ou cliente desconectado.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or random.random() >= PROFILE_SAMPLE_RATE:
+            await self.app(scope, receive, send)
+            return
+
+        session = profiler.begin(scope["path"])
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.end(session)
@@ -0,0 +1,181 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from . import metrics
+from .config import get_settings
+
+_settings = get_settings()
+
+# Limites de concorrência para trabalho que bate na OpenAI (agente, embeddings, reranking)
+LLM_MAX_CONCURRENCY = _settings.llm_max_concurrency
+LLM_MAX_CONCURRENCY_PER_RESTAURANT = _settings.llm_max_concurrency_per_restaurant
+# Fila de espera limitada: quem passar disso recebe 429 na hora
+LLM_QUEUE_MAX = _settings.llm_queue_max
+LLM_QUEUE_MAX_PER_RESTAURANT = _settings.llm_queue_max_per_restaurant
+# Tempo máximo (segundos) esperando um slot antes de desistir com 429
+LLM_QUEUE_TIMEOUT = _settings.llm_queue_timeout
+
+# Restaurante da requisição atual (setado em /chat ou pela tool) e se o contexto já tem um slot.
+# Chamadas aninhadas (tools dentro de menux_agent.run) reaproveitam o slot do chamador.
+current_restaurant: ContextVar[str] = ContextVar("current_restaurant", default="")
+_slot_held: ContextVar[bool] = ContextVar("_slot_held", default=False)
+
+metrics.describe("menux_scheduler_in_flight", "Trabalhos LLM em execução.")
+metrics.describe("menux_scheduler_queue_depth", "Requisições aguardando slot LLM.")
+metrics.describe("menux_scheduler_wait_seconds", "Tempo de espera por slot LLM.")
+metrics.describe("menux_scheduler_rejected_total", "Requisições rejeitadas com 429.")
+
+
+class SchedulerOverloaded(Exception):
+    """Sem capacidade para aceitar o trabalho agora. `retry_after` em segundos (para o header Retry-After)."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Capacidade esgotada ({reason}). Tente novamente em {retry_after}s.")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class UpstreamScheduler:
+    """
+    Controle de admissão para trabalho LLM-bound.
+
+    Cada trabalho precisa de um slot do restaurante E um slot global. Um restaurante
+    lotado espera no próprio semáforo (sem segurar slots globais), então não degrada
+    a latência dos outros. A espera é uma fila limitada com prazo: fila cheia ou prazo
+    estourado viram `SchedulerOverloaded` (429 + Retry-After na API).
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        max_per_restaurant: int = LLM_MAX_CONCURRENCY_PER_RESTAURANT,
+        max_queue: int = LLM_QUEUE_MAX,
+        max_queue_per_restaurant: int = LLM_QUEUE_MAX_PER_RESTAURANT,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_per_restaurant = max_per_restaurant
+        self.max_queue = max_queue
+        self.max_queue_per_restaurant = max_queue_per_restaurant
+        self.queue_timeout = queue_timeout
+
+        self._global = asyncio.Semaphore(max_concurrency)
+        # Semáforo por restaurante, criado sob demanda e descartado quando ninguém mais o usa
+        # (o id vem do cliente: sem isso o dicionário cresceria sem limite)
+        self._restaurants: Dict[str, asyncio.Semaphore] = {}
+        self._restaurant_refs: Dict[str, int] = {}
+        self._waiting = 0
+        self._waiting_by_restaurant: Dict[str, int] = {}
+        self._in_flight = 0
+        # Média móvel do tempo de posse de um slot, usada para estimar o Retry-After
+        self._avg_hold = 1.0
+
+    def _enter_restaurant(self, restaurant_id: str) -> asyncio.Semaphore:
+        if restaurant_id not in self._restaurants:
+            self._restaurants[restaurant_id] = asyncio.Semaphore(self.max_per_restaurant)
+        self._restaurant_refs[restaurant_id] = self._restaurant_refs.get(restaurant_id, 0) + 1
+        return self._restaurants[restaurant_id]
+
+    def _leave_restaurant(self, restaurant_id: str):
+        self._restaurant_refs[restaurant_id] -= 1
+        if self._restaurant_refs[restaurant_id] == 0:
+            del self._restaurant_refs[restaurant_id]
+            del self._restaurants[restaurant_id]
+
+    def retry_after(self) -> int:
+        """Estimativa de quando haverá slot: fila / vazão média."""
+        return max(1, math.ceil(self._avg_hold * (self._waiting + 1) / self.max_concurrency))
+
+    def _reject(self, restaurant_id: str, reason: str):
+        metrics.inc("menux_scheduler_rejected_total", restaurant=restaurant_id, reason=reason)
+        raise SchedulerOverloaded(reason, self.retry_after())
+
+    def _set_queue_gauges(self, restaurant_id: str):
+        metrics.set_gauge("menux_scheduler_queue_depth", self._waiting)
+        waiting = self._waiting_by_restaurant.get(restaurant_id, 0)
+        if waiting:
+            metrics.set_gauge("menux_scheduler_queue_depth", waiting, restaurant=restaurant_id)
+        else:
+            # Fila do restaurante vazia: remove a entrada e a série do gauge
+            self._waiting_by_restaurant.pop(restaurant_id, None)
+            metrics.remove_gauge("menux_scheduler_queue_depth", restaurant=restaurant_id)
+
+    async def _acquire(self, restaurant_sem: asyncio.Semaphore):
+        # Primeiro o slot do restaurante, depois o global (quem está lotado não segura slot global)
+        await restaurant_sem.acquire()
+        try:
+            await self._global.acquire()
+        except BaseException:
+            restaurant_sem.release()
+            raise
+
+    async def _admit(self, restaurant_id: str, restaurant_sem: asyncio.Semaphore):
+        # Caminho rápido: há slot livre, sem passar pela fila
+        if not restaurant_sem.locked() and not self._global.locked():
+            await self._acquire(restaurant_sem)
+            return
+
+        if self._waiting >= self.max_queue:
+            self._reject(restaurant_id, "queue_full")
+        if self._waiting_by_restaurant.get(restaurant_id, 0) >= self.max_queue_per_restaurant:
+            self._reject(restaurant_id, "restaurant_queue_full")
+
+        self._waiting += 1
+        self._waiting_by_restaurant[restaurant_id] = self._waiting_by_restaurant.get(restaurant_id, 0) + 1
+        self._set_queue_gauges(restaurant_id)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._acquire(restaurant_sem), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject(restaurant_id, "queue_timeout")
+        finally:
+            self._waiting -= 1
+            self._waiting_by_restaurant[restaurant_id] -= 1
+            self._set_queue_gauges(restaurant_id)
+            metrics.observe("menux_scheduler_wait_seconds", time.perf_counter() - start)
+
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "in_flight": self._in_flight,
+            "queue_depth": self._waiting,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+        }
+
+    @asynccontextmanager
+    async def slot(self, restaurant_id: Optional[str] = None):
+        """Segura um slot LLM durante o bloco. Reentrante: aninhado no mesmo contexto não espera."""
+        if _slot_held.get():
+            yield
+            return
+
+        restaurant_id = restaurant_id or current_restaurant.get() or "default"
+        restaurant_sem = self._enter_restaurant(restaurant_id)
+        try:
+            await self._admit(restaurant_id, restaurant_sem)
+        except BaseException:
+            self._leave_restaurant(restaurant_id)
+            raise
+
+        self._in_flight += 1
+        metrics.set_gauge("menux_scheduler_in_flight", self._in_flight)
+        token = _slot_held.set(True)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _slot_held.reset(token)
+            self._avg_hold = 0.9 * self._avg_hold + 0.1 * (time.perf_counter() - start)
+            self._in_flight -= 1
+            metrics.set_gauge("menux_scheduler_in_flight", self._in_flight)
+            self._global.release()
+            restaurant_sem.release()
+            self._leave_restaurant(restaurant_id)
+
+
+# Instância única do processo
+llm_scheduler = UpstreamScheduler()
@@ -0,0 +1,92 @@
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from . import metrics
+from .config import get_settings
+from .filters import content_tokens, token_overlap, normalize_text
+from .models import SuggestionRequest
+
+_settings = get_settings()
+
+SESSION_CURSOR_TTL_SECONDS = _settings.session_cursor_ttl_seconds
+SESSION_CURSOR_MAX_SESSIONS = _settings.session_cursor_max_sessions
+# Tamanho da lista ranqueada guardada por sessão (o reranker vê no máximo MAX_RERANK_CANDIDATES por vez)
+CURSOR_POOL_SIZE = 75
+# Similaridade mínima (Jaccard dos termos) entre o pedido novo e o da busca guardada.
+# Pedido sem termo nenhum ("outra opção") herda a intenção da busca anterior.
+CURSOR_MIN_OVERLAP = 0.5
+
+metrics.describe("menux_session_cursor_total", "Buscas de follow-up por resultado do cursor (hit, miss, stale, exhausted).")
+
+
+def _filters_key(req: SuggestionRequest) -> Tuple[Any, ...]:
+    """Parte da intenção que muda a máscara de filtros: se mudou, a lista guardada não vale."""
+    return (
+        req.categoria_foco.value,
+        normalize_text(req.restricoes or ""),
+        normalize_text(req.preferencias or ""),
+        req.preco_maximo,
+    )
+
+
+class CandidateCursor:
+    """Lista ranqueada (já filtrada) da última busca de uma sessão e o que já foi mostrado."""
+
+    def __init__(self, restaurant_id: str, index: Any, req: SuggestionRequest, pool: List[Dict[str, Any]]):
+        self.restaurant_id = restaurant_id
+        # Referência fraca: se o cardápio for recarregado, o índice antigo morre e o cursor fica obsoleto
+        self.index_ref = weakref.ref(index)
+        self.filters_key = _filters_key(req)
+        self.tokens = content_tokens(req.pedido_usuario)
+        self.pool = pool
+        self.shown: Set[str] = set()
+        self.expires_at = time.monotonic() + SESSION_CURSOR_TTL_SECONDS
+
+    def matches(self, restaurant_id: str, index: Any, req: SuggestionRequest) -> bool:
+        if restaurant_id != self.restaurant_id or self.index_ref() is not index:
+            return False
+        if _filters_key(req) != self.filters_key:
+            return False
+        tokens = content_tokens(req.pedido_usuario)
+        return not tokens or token_overlap(tokens, self.tokens) >= CURSOR_MIN_OVERLAP
+
+    def next_page(self, excluded_ids: List[str], size: int) -> List[Dict[str, Any]]:
+        """Próximos candidatos ainda não mostrados nem rejeitados, na ordem original."""
+        skip = self.shown.union(excluded_ids)
+        return [item for item in self.pool if item["id"] not in skip][:size]
+
+    def mark_shown(self, ids: List[str]):
+        self.shown.update(ids)
+
+
+class SessionCursorStore:
+    """Cursores por sessão em memória, com TTL e limite de sessões (LRU)."""
+
+    def __init__(self, max_sessions: int = SESSION_CURSOR_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._cursors: "OrderedDict[str, CandidateCursor]" = OrderedDict()
+
+    def get(self, session_id: str) -> Optional[CandidateCursor]:
+        cursor = self._cursors.get(session_id)
+        if cursor is None:
+            return None
+        if cursor.expires_at < time.monotonic():
+            del self._cursors[session_id]
+            return None
+        self._cursors.move_to_end(session_id)
+        return cursor
+
+    def put(self, session_id: str, cursor: CandidateCursor):
+        self._cursors[session_id] = cursor
+        self._cursors.move_to_end(session_id)
+        while len(self._cursors) > self.max_sessions:
+            self._cursors.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._cursors)
+
+
+# Instância única do processo
+session_cursors = SessionCursorStore()
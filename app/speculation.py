@@ -0,0 +1,65 @@
+import asyncio
+from typing import List, Optional
+
+from . import metrics
+from .filters import content_tokens, token_overlap
+from .tools import get_embedding
+
+# Similaridade (Jaccard dos termos) mínima entre a mensagem e o `pedido_usuario` da tool
+# para aceitarmos o vetor especulado no lugar de um embedding novo.
+SPECULATION_MIN_OVERLAP = 0.6
+
+metrics.describe("menux_speculation_total", "Embeddings especulativos por resultado (hit, miss, skipped, unused, failed).")
+
+
+def is_greeting_like(message: str) -> bool:
+    """Mensagem sem nenhum termo de busca (saudação, conversa, pedido vago)."""
+    return not content_tokens(message)
+
+
+class SpeculativeEmbedding:
+    """
+    Embedding da mensagem crua do usuário, disparado em paralelo com a primeira chamada
+    do agente. Quando a tool de busca é chamada com um `pedido_usuario` parecido com a
+    mensagem, o vetor já está pronto (ou quase) e economizamos um round trip serial.
+    """
+
+    def __init__(self, message: str):
+        self.message = message
+        self.tokens = content_tokens(message)
+        # Já passou por take() (hit, miss ou failed): o resultado foi contado lá
+        self.taken = False
+        self.task: asyncio.Task = asyncio.create_task(get_embedding(message))
+
+    def matches(self, query: str) -> bool:
+        return token_overlap(content_tokens(query), self.tokens) >= SPECULATION_MIN_OVERLAP
+
+    async def take(self, query: str) -> Optional[List[float]]:
+        """Vetor especulado se `query` bater com a mensagem; None para o caller gerar o seu."""
+        self.taken = True
+        if not self.matches(query):
+            metrics.inc("menux_speculation_total", outcome="miss")
+            return None
+
+        vec = await self.task
+        if not vec:
+            metrics.inc("menux_speculation_total", outcome="failed")
+            return None
+
+        metrics.inc("menux_speculation_total", outcome="hit")
+        return vec
+
+    def finish(self):
+        """Fim da requisição: cancela se ainda estiver rodando e conta `unused` se ninguém pediu o vetor."""
+        if not self.task.done():
+            self.task.cancel()
+        if not self.taken:
+            metrics.inc("menux_speculation_total", outcome="unused")
+
+
+def start_speculation(message: str) -> Optional[SpeculativeEmbedding]:
+    """Dispara a especulação, exceto para mensagens que não vão virar busca."""
+    if is_greeting_like(message):
+        metrics.inc("menux_speculation_total", outcome="skipped")
+        return None
+    return SpeculativeEmbedding(message)
@@ -1,94 +1,267 @@
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, TYPE_CHECKING
 import httpx
-import os
 import asyncio
+import time
 import numpy as np
-from openai import AsyncOpenAI
 from .models import SuggestionRequest, SuggestionResult, MenuItem, CategoriaProduto
 from .logger import VisualLogger
-from dotenv import load_dotenv
+from .embedding_store import embedding_store, EMBEDDING_MODEL
+from .menu_index import MenuIndex, FOCUS_CATEGORIES, focus_embedding_text
+from .filters import build_filter_mask, preference_boost, lexical_terms
+from .scheduler import llm_scheduler, SchedulerOverloaded
+from .batcher import EmbeddingBatcher
+from .deadline import (
+    current_deadline, time_left, budget_wait, record_fallback,
+    EMBEDDING_TIMEOUT, MENU_FETCH_TIMEOUT, MENU_LOAD_TIMEOUT,
+    RERANK_TIMEOUT, RERANK_RESERVE_SECONDS, MIN_RERANK_BUDGET,
+)
+from .config import get_settings
+from .usage import record_usage, current_usage
+from . import metrics
+from .circuit import (
+    CircuitBreaker, CircuitOpen, is_upstream_status,
+    login_circuit, menu_items_circuit, categories_circuit, embeddings_circuit, chat_circuit,
+)
+from .session_cursor import session_cursors, CandidateCursor, CURSOR_POOL_SIZE
 
-load_dotenv()
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
 
-API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:3000/api/v1")
+_settings = get_settings()
+
+API_BASE_URL = _settings.api_base_url
 
 # Credenciais (devem ser configuradas no .env)
-AUTH_EMAIL = os.getenv("AUTH_EMAIL")
-AUTH_PASSWORD = os.getenv("AUTH_PASSWORD")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+AUTH_EMAIL = _settings.auth_email
+AUTH_PASSWORD = _settings.auth_password
+OPENAI_API_KEY = _settings.openai_api_key
 
-# Cache de Embeddings (Em Memória)
-# Dict[restaurant_id, Dict[str_id, Dict[str, Any]]] -> armazena item completo + 'embedding'
+# Cache do Cardápio (Em Memória)
+# Dict[restaurant_id, Dict[str_id, Dict[str, Any]]] -> armazena o item completo.
+# Os vetores ficam no `embedding_store` compartilhado (ver CACHE_MENU_INDEX).
 CACHE_MENU_EMBEDDINGS: Dict[str, Dict[str, Dict[str, Any]]] = {}
 CACHE_CATEGORIES: Dict[str, str] = {}
 
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-
-async def get_access_token() -> Optional[str]:
-    """Realiza login e retorna o access_token."""
-    async with httpx.AsyncClient() as client:
-        try:
-            payload = {"email": AUTH_EMAIL, "password": AUTH_PASSWORD}
-            response = await client.post(f"{API_BASE_URL}/auth/login", json=payload, timeout=5.0)
-            response.raise_for_status()
-            data = response.json()
-            return data.get("access_token")
-        except Exception as e:
-            print(f"Erro no Login: {e}")
-            return None
+# Índice vetorial por restaurante (matriz + subconjuntos por categoria), montado no refresh
+CACHE_MENU_INDEX: Dict[str, MenuIndex] = {}
+# Embeddings dos focos (CategoriaProduto) - independem do restaurante, gerados uma vez só
+CACHE_FOCUS_EMBEDDINGS: Dict[CategoriaProduto, List[float]] = {}
+# Refresh em andamento por restaurante (requisições concorrentes esperam o mesmo)
+_REFRESH_TASKS: Dict[str, asyncio.Task] = {}
+
+# Similaridade mínima para um item virar candidato e tamanho do pool enviado ao reranker
+MIN_SIMILARITY = 0.15
+MAX_RERANK_CANDIDATES = 25
+
+# Modelo do reranker
+RERANK_MODEL = "gpt-4o-mini"
+
+_openai_client: Optional["AsyncOpenAI"] = None
+
+def get_openai_client() -> "AsyncOpenAI":
+    """Cliente OpenAI criado no primeiro uso (o import do SDK é pesado para o cold start)."""
+    global _openai_client
+    if _openai_client is None:
+        from openai import AsyncOpenAI
+        # Sem retry do SDK: o orçamento da requisição decide, e cada chamada passa o timeout do seu estágio
+        _openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+    return _openai_client
+
+# Token da API de menu reaproveitado entre chamadas (sem um login por requisição)
+ACCESS_TOKEN_TTL = 600
+_access_token: Optional[str] = None
+_access_token_expires_at = 0.0
+
+async def _menu_api_request(circuit: CircuitBreaker, method: str, path: str, **kwargs) -> httpx.Response:
+    """
+    Chamada à API de menu protegida pelo circuit breaker. O cliente HTTP usa o timeout do estágio
+    (estourar conta como falha do upstream); o prazo da requisição corta por fora e não conta (`budget_wait`).
+    """
+    async def _call() -> httpx.Response:
+        async with circuit.guard():
+            async with httpx.AsyncClient() as client:
+                response = await client.request(method, f"{API_BASE_URL}{path}", timeout=MENU_FETCH_TIMEOUT, **kwargs)
+            if is_upstream_status(response.status_code):
+                response.raise_for_status()
+            return response
+
+    return await asyncio.wait_for(_call(), timeout=budget_wait(time_left(MENU_FETCH_TIMEOUT), MENU_FETCH_TIMEOUT))
+
+async def get_access_token(force_refresh: bool = False) -> Optional[str]:
+    """Realiza login e retorna o access_token (em cache por até ACCESS_TOKEN_TTL segundos)."""
+    global _access_token, _access_token_expires_at
+    if _access_token and not force_refresh and time.monotonic() < _access_token_expires_at:
+        return _access_token
+
+    try:
+        payload = {"email": AUTH_EMAIL, "password": AUTH_PASSWORD}
+        response = await _menu_api_request(login_circuit, "POST", "/auth/login", json=payload)
+        response.raise_for_status()
+        data = response.json()
+    except CircuitOpen:
+        record_fallback("login_circuit_open")
+        return None
+    except Exception as e:
+        print(f"Erro no Login: {e}")
+        return None
+
+    _access_token = data.get("access_token")
+    _access_token_expires_at = time.monotonic() + min(float(data.get("expires_in") or ACCESS_TOKEN_TTL), ACCESS_TOKEN_TTL)
+    return _access_token
+
+async def _menu_api_get(path: str, circuit: CircuitBreaker, retry_auth: bool = True) -> Any:
+    """GET autenticado na API de menu, protegido pelo circuit breaker do endpoint. Levanta exceção se falhar."""
+    token = await get_access_token(force_refresh=not retry_auth)
+    if not token:
+        raise RuntimeError("Sem token de acesso à API de menu")
+
+    headers = {"Authorization": f"Bearer {token}"}
+    response = await _menu_api_request(circuit, "GET", path, headers=headers)
+    if response.status_code == 401 and retry_auth:
+        # Token expirou antes do previsto: novo login e mais uma tentativa
+        return await _menu_api_get(path, circuit, retry_auth=False)
+    response.raise_for_status()
+    return response.json()
 
 async def fetch_menu_items(restaurant_id: str) -> List[Dict[str, Any]]:
     """Busca todos os itens do menu da API, realizando login antes."""
-    token = await get_access_token()
-    if not token:
+    try:
+        return await _menu_api_get(f"/menu-items?restaurantId={restaurant_id}", menu_items_circuit)
+    except CircuitOpen:
+        # O índice anterior (se houver) continua valendo: refresh_menu_embeddings não mexe no cache
+        record_fallback("menu_circuit_open")
+        return []
+    except Exception as e:
+        print(f"Erro na API de Menu: {e}")
         return []
 
-    headers = {"Authorization": f"Bearer {token}"}
-    
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f"{API_BASE_URL}/menu-items?restaurantId={restaurant_id}", headers=headers, timeout=10.0)
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            print(f"Erro na API de Menu: {e}")
-            return []
+def _categories_from_menu(restaurant_id: str) -> str:
+    """Categorias tiradas do cardápio em cache, para quando a API de categorias está fora."""
+    menu = CACHE_MENU_EMBEDDINGS.get(restaurant_id)
+    if not menu:
+        return "Indisponível no momento."
+    names = dict.fromkeys((item.get("category") or {}).get("name") or "Outros" for item in menu.values())
+    return "\n".join(f"- {name}" for name in names)
 
 async def fetch_category_names(restaurant_id: str) -> str:
     """Busca árvore de categorias."""
     if restaurant_id in CACHE_CATEGORIES:
         return CACHE_CATEGORIES[restaurant_id]
 
-    token = await get_access_token()
-    if not token: return "Erro ao carregar categorias."
-    
-    headers = {"Authorization": f"Bearer {token}"}
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f"{API_BASE_URL}/categories?restaurantId={restaurant_id}", headers=headers, timeout=10.0)
-            response.raise_for_status()
-            data = response.json()
-            lines = []
-            for cat in data:
-                if cat.get("pai"): continue
-                name = cat.get("name", "")
-                subs = [sub.get("name") for sub in cat.get("subcategories", [])]
-                if subs: lines.append(f"- {name} ({', '.join(subs)})")
-                else: lines.append(f"- {name}")
-            cats_str = "\n".join(lines)
-            CACHE_CATEGORIES[restaurant_id] = cats_str
-            return cats_str
-        except Exception:
-            return "Indisponível no momento."
+    try:
+        data = await _menu_api_get(f"/categories?restaurantId={restaurant_id}", categories_circuit)
+    except CircuitOpen:
+        record_fallback("categories_circuit_open")
+        return _categories_from_menu(restaurant_id)
+    except Exception as e:
+        print(f"Erro na API de Categorias: {e}")
+        return _categories_from_menu(restaurant_id)
+
+    lines = []
+    for cat in data:
+        if cat.get("pai"): continue
+        name = cat.get("name", "")
+        subs = [sub.get("name") for sub in cat.get("subcategories", [])]
+        if subs: lines.append(f"- {name} ({', '.join(subs)})")
+        else: lines.append(f"- {name}")
+    cats_str = "\n".join(lines)
+    CACHE_CATEGORIES[restaurant_id] = cats_str
+    return cats_str
+
+# Status HTTP de entrada inválida (texto grande demais, malformado): culpa do pedido, não do upstream
+_INPUT_ERROR_STATUS = (400, 413, 422)
+
+def _is_input_error(error: Exception) -> bool:
+    return getattr(error, "status_code", None) in _INPUT_ERROR_STATUS
+
+def _is_client_timeout(error: Exception) -> bool:
+    """Timeout do próprio cliente HTTP/SDK (o upstream não respondeu dentro do teto do estágio)."""
+    import openai
+    return isinstance(error, (openai.APITimeoutError, httpx.TimeoutException))
+
+async def _create_embeddings(texts: List[str], timeout: float = EMBEDDING_TIMEOUT) -> Tuple[List[List[float]], int]:
+    """
+    Chamada crua ao embeddings.create: (vetores, tokens consumidos). Levanta exceção em caso de erro.
+    O circuit breaker fica aqui, em volta da chamada de rede: um lote compartilhado por vários
+    chamadores conta uma falha só. O SDK usa `timeout` (teto do estágio): upstream travado estoura
+    aqui dentro e conta como falha.
+    """
+    async with embeddings_circuit.guard():
+        resp = await get_openai_client().embeddings.create(input=texts, model=EMBEDDING_MODEL, timeout=timeout)
+    # A ordem de resp.data é garantida ser a mesma de input
+    return [d.embedding for d in resp.data], resp.usage.prompt_tokens
+
+# Junta get_embedding concorrentes (de requisições diferentes) em uma chamada só
+embedding_batcher = EmbeddingBatcher(_create_embeddings, is_input_error=_is_input_error)
 
 async def get_embedding(text: str) -> List[float]:
     """Gera embedding usando OpenAI ada-002 ou text-embedding-3-small."""
+    timeout = time_left(EMBEDDING_TIMEOUT)
+    if timeout <= 0:
+        record_fallback("embedding_skipped")
+        return []
+    if embeddings_circuit.is_open():
+        record_fallback("embedding_circuit_open")
+        return []
+
     try:
         text = text.replace("\n", " ")
-        resp = await openai_client.embeddings.create(input=[text], model="text-embedding-3-small")
-        return resp.data[0].embedding
+        async with llm_scheduler.slot():
+            vector, tokens = await asyncio.wait_for(
+                embedding_batcher.embed(text), timeout=budget_wait(timeout, EMBEDDING_TIMEOUT)
+            )
+        # A chamada é compartilhada com outras requisições: conta só a nossa parte dos tokens
+        record_usage("embedding", EMBEDDING_MODEL, input_tokens=round(tokens))
+        return vector
+    except CircuitOpen:
+        record_fallback("embedding_circuit_open")
+        return []
+    except asyncio.TimeoutError:
+        print(f"Timeout OpenAI Embedding ({timeout:.1f}s)")
+        record_fallback("embedding_timeout")
+        return []
     except Exception as e:
         print(f"Erro OpenAI Embedding: {e}")
+        record_fallback("embedding_timeout" if _is_client_timeout(e) else "embedding_error")
+        return []
+
+async def get_embeddings(
+    texts: List[str],
+    restaurant_id: Optional[str] = None,
+    timeout: float = EMBEDDING_TIMEOUT,
+    tool: str = "embedding",
+) -> List[List[float]]:
+    """Gera embeddings de vários textos em UMA chamada (mesma ordem do input). Vazio se falhar."""
+    if not texts: return []
+    limit, timeout = timeout, time_left(timeout)
+    if timeout <= 0:
+        record_fallback("embedding_skipped")
+        return []
+    if embeddings_circuit.is_open():
+        record_fallback("embedding_circuit_open")
+        return []
+
+    try:
+        inputs = [t.replace("\n", " ") for t in texts]
+        async with llm_scheduler.slot(restaurant_id):
+            vectors, tokens = await asyncio.wait_for(
+                _create_embeddings(inputs, timeout=limit), timeout=budget_wait(timeout, limit)
+            )
+        record_usage(tool, EMBEDDING_MODEL, input_tokens=tokens)
+        return vectors
+    except CircuitOpen:
+        record_fallback("embedding_circuit_open")
+        return []
+    except asyncio.TimeoutError:
+        print(f"Timeout OpenAI Embedding em lote ({len(texts)} textos, {timeout:.1f}s)")
+        record_fallback("embedding_timeout")
+        return []
+    except SchedulerOverloaded:
+        # Sem slot não é falha da OpenAI: o caller decide (429 no /recommend/batch)
+        raise
+    except Exception as e:
+        print(f"Erro OpenAI Embedding em lote: {e}")
+        record_fallback("embedding_timeout" if _is_client_timeout(e) else "embedding_error")
         return []
 
 async def refresh_menu_embeddings(restaurant_id: str):
@@ -120,172 +293,404 @@ async def refresh_menu_embeddings(restaurant_id: str):
     
     if not texts_to_embed: return
 
+    # Os focos (CategoriaProduto) vão no mesmo lote na primeira vez, sem round trip extra
+    missing_focus = [f for f in FOCUS_CATEGORIES if f not in CACHE_FOCUS_EMBEDDINGS]
+    focus_texts = [focus_embedding_text(f) for f in missing_focus]
+
+    # Store endereçado por conteúdo: só textos nunca vistos (em NENHUM restaurante) vão
+    # para a OpenAI, numa chamada ÚNICA (Batch). Franquias com o mesmo item reaproveitam o vetor.
+    rows = await embedding_store.acquire(
+        texts_to_embed + focus_texts,
+        lambda texts: get_embeddings(texts, restaurant_id, timeout=MENU_LOAD_TIMEOUT, tool="menu_embedding"),
+    )
+    if rows is None:
+        print(f"{VisualLogger.FAIL}Erro Batch Embedding para {restaurant_id}{VisualLogger.ENDC}")
+        return
+
     try:
-        # Chamada ÚNICA para a API (Batch)
-        # O modelo text-embedding-3-small aceita arrays de strings
-        resp = await openai_client.embeddings.create(input=texts_to_embed, model="text-embedding-3-small")
-        
-        if restaurant_id not in CACHE_MENU_EMBEDDINGS:
-            CACHE_MENU_EMBEDDINGS[restaurant_id] = {}
-            
-        # Mapeia resultados de volta para os itens
-        for i, embedding_data in enumerate(resp.data):
-            # A ordem de resp.data é garantida ser a mesma de input
-            item = valid_items[i]
-            item["embedding"] = embedding_data.embedding
-            CACHE_MENU_EMBEDDINGS[restaurant_id][item["id"]] = item
+        # A ordem das linhas é a mesma dos textos
+        item_rows = rows[:len(valid_items)]
+        for focus, row in zip(missing_focus, rows[len(valid_items):]):
+            CACHE_FOCUS_EMBEDDINGS[focus] = embedding_store.vectors[row].copy()
+
+        previous = CACHE_MENU_INDEX.get(restaurant_id)
+        CACHE_MENU_EMBEDDINGS[restaurant_id] = {item["id"]: item for item in valid_items}
+        CACHE_MENU_INDEX[restaurant_id] = MenuIndex(valid_items, embedding_store, item_rows, CACHE_FOCUS_EMBEDDINGS)
+
+        # Devolve as referências do cardápio anterior (itens que saíram do menu saem do store)
+        if previous is not None:
+            embedding_store.release(previous.store_rows)
             
-        print(f"{VisualLogger.OKGREEN}✅ {len(CACHE_MENU_EMBEDDINGS[restaurant_id])} Embeddings Gerados em 1 Batch para {restaurant_id}!{VisualLogger.ENDC}")
+        print(f"{VisualLogger.OKGREEN}✅ {len(valid_items)} Embeddings prontos para {restaurant_id} ({len(embedding_store)} vetores únicos no store)!{VisualLogger.ENDC}")
         
     except Exception as e:
-        print(f"{VisualLogger.FAIL}Erro Batch Embedding: {e}{VisualLogger.ENDC}")
+        embedding_store.release(rows)
+        print(f"{VisualLogger.FAIL}Erro ao montar índice do cardápio: {e}{VisualLogger.ENDC}")
+
+async def _refresh_in_background(restaurant_id: str):
+    # Roda fora do prazo da requisição que disparou: se ela desistir, o cache ainda serve as próximas
+    current_deadline.set(None)
+    # Nem do consumo dela: o cardápio é pago pelo restaurante, não pelo turno que o carregou
+    current_usage.set(None)
+    await refresh_menu_embeddings(restaurant_id)
+
+async def get_menu_index(restaurant_id: str) -> Optional[MenuIndex]:
+    """Retorna o índice vetorial do restaurante, gerando os embeddings se ainda não existir."""
+    if restaurant_id in CACHE_MENU_INDEX:
+        return CACHE_MENU_INDEX[restaurant_id]
+
+    task = _REFRESH_TASKS.get(restaurant_id)
+    if task is None:
+        task = asyncio.create_task(_refresh_in_background(restaurant_id))
+        _REFRESH_TASKS[restaurant_id] = task
+        task.add_done_callback(lambda _: _REFRESH_TASKS.pop(restaurant_id, None))
+
+    try:
+        await asyncio.wait_for(asyncio.shield(task), timeout=time_left(MENU_LOAD_TIMEOUT))
+    except asyncio.TimeoutError:
+        record_fallback("menu_load_timeout")
+    return CACHE_MENU_INDEX.get(restaurant_id)
+
+def _to_menu_item(item: Dict[str, Any]) -> MenuItem:
+    return MenuItem(
+        id=item["id"],
+        nome=item["name"],
+        preco=str(item["price"]),
+        categoria=item.get("category", {}).get("name", "Outros"),
+        descricao=item.get("description", "") or "Sem descrição disponível."
+    )
 
-async def pick_random_items(qtd: int = 3, category_focus: str = "todas", restaurant_id: str = "") -> list[MenuItem]:
+async def get_items_by_ids(restaurant_id: str, ids: List[str]) -> List[MenuItem]:
+    """Detalhes completos de itens já sugeridos (o histórico guarda só id, nome e preço)."""
+    if await get_menu_index(restaurant_id) is None:
+        return []
+    menu = CACHE_MENU_EMBEDDINGS.get(restaurant_id, {})
+    return [_to_menu_item(menu[item_id]) for item_id in dict.fromkeys(ids) if item_id in menu]
+
+async def pick_random_items(
+    qtd: int = 3,
+    category_focus: str = "todas",
+    restaurant_id: str = "",
+    req: Optional[SuggestionRequest] = None,
+) -> list[MenuItem]:
     """Seleciona itens aleatórios do cache para o modo 'Surpreenda-me'."""
     import random
     
-    cache_restante = CACHE_MENU_EMBEDDINGS.get(restaurant_id, {})
-    if not cache_restante:
-        await refresh_menu_embeddings(restaurant_id)
-        cache_restante = CACHE_MENU_EMBEDDINGS.get(restaurant_id, {})
-        
-    candidate_items = []
+    index = await get_menu_index(restaurant_id)
+    if index is None:
+        return []
+
+    # Disponibilidade, restrições e preço valem também para a surpresa
+    allowed = build_filter_mask(index, req)
+
+    try:
+        focus = CategoriaProduto(category_focus.lower())
+    except ValueError:
+        focus = CategoriaProduto.TODAS
 
     # 1. Se "todas", pegamos tudo.
-    if category_focus.lower() == "todas":
-        candidate_items = list(cache_restante.values())
-        random.shuffle(candidate_items)
-        selected_raw = candidate_items[:qtd]
+    if focus == CategoriaProduto.TODAS:
+        candidate_rows = list(np.flatnonzero(allowed))
 
     else:
-        # 2. Se tem foco (ex: "vinhos", "bebidas"), usamos Busca Vetorial!
-        # Isso garante que "suco" seja encontrado perto de "bebidas" sem hardcode.
-        nome_foco = category_focus.replace("_", " ") # ex: pratos_principais -> pratos principais
-        vec_foco = await get_embedding(nome_foco)
-        
-        if not vec_foco:
-            # Fallback seguro: pega tudo se falhar embedding
-            candidate_items = list(CACHE_MENU_EMBEDDINGS.values())
-            random.shuffle(candidate_items)
-            selected_raw = candidate_items[:qtd]
-        else:
-            scored = []
-            for item in cache_restante.values():
-                sim = cosine_similarity(vec_foco, item["embedding"])
-                scored.append((sim, item))
-            
-            # Ordena por similaridade
-            scored.sort(key=lambda x: x[0], reverse=True)
-            
-            # Pega o Top 10 (para ter variedade e não só o Top 1 sempre)
-            top_candidates = [x[1] for x in scored[:10]]
-            
-            # Desses Top 10, escolhe aleatoriamente
-            random.shuffle(top_candidates)
-            selected_raw = top_candidates[:qtd]
-
-    return [
-        MenuItem(
-            id=i["id"], 
-            nome=i["name"], 
-            preco=str(i["price"]), 
-            categoria=i.get("category", {}).get("name", "Outros"), 
-            descricao=i.get("description", "") or "Sem descrição disponível."
-        ) for i in selected_raw
-    ]
-
-def cosine_similarity(v1: List[float], v2: List[float]) -> float:
-    return np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
-
-async def agente_gastronomico(req: SuggestionRequest, restaurant_id: str = "") -> SuggestionResult:
+        # 2. Se tem foco (ex: "vinhos", "bebidas"), usamos as categorias já resolvidas
+        # no índice (similaridade foco x centróide), sem gerar embedding por chamada.
+        focus_rows = index.focus_rows.get(focus, index.all_rows)
+        candidate_rows = list(focus_rows[allowed[focus_rows]])
+
+        if len(candidate_rows) < qtd:
+            # Poucos itens na categoria: Top 10 por similaridade com o vetor pré-computado do foco
+            # (para ter variedade e não só o Top 1 sempre)
+            allowed_rows = np.flatnonzero(allowed)
+            vec_foco = index.focus_vectors.get(focus)
+            if vec_foco is None:
+                candidate_rows = list(allowed_rows)
+            else:
+                sims = index.score(vec_foco, allowed_rows)
+                candidate_rows = list(allowed_rows[np.argsort(-sims)[:10]])
+
+    # Desses candidatos, escolhe aleatoriamente
+    random.shuffle(candidate_rows)
+    return [_to_menu_item(index.items[row]) for row in candidate_rows[:qtd]]
+
+def _vector_candidates(
+    index: MenuIndex,
+    req: SuggestionRequest,
+    query_vec: Optional[List[float]] = None,
+    scores: Optional[np.ndarray] = None,
+    limit: int = MAX_RERANK_CANDIDATES,
+) -> List[Dict[str, Any]]:
+    """
+    Busca vetorial no índice: pontua só o subconjunto do foco (ou o cardápio todo),
+    já sem os itens excluídos, e devolve o pool ordenado para o reranker.
+    `scores` (1 por item do índice) permite reaproveitar uma pontuação feita em lote
+    (`MenuIndex.score_many`) no lugar de `query_vec`.
+    """
+    # 0. Filtros estruturados (disponibilidade, restrições, preço) viram uma máscara booleana
+    # aplicada ANTES da pontuação, junto com a Exclusão (Evitar repetições) e o Pré-filtro de Categoria
+    mask = build_filter_mask(index, req)
+    rows = index.candidate_rows(req.categoria_foco, req.excluded_ids, mask)
+    if not len(rows):
+        return []
+
+    # 1. Similaridade de cosseno em lote (matriz já normalizada)
+    sims = scores[rows] if scores is not None else index.score(query_vec, rows)
+    keep = sims > MIN_SIMILARITY
+    rows, sims = rows[keep], sims[keep]
+
+    # Soft boost para tags citadas nas preferências (não elimina ninguém)
+    boost = preference_boost(index, req)
+    if boost is not None:
+        sims = sims + boost[rows]
+
+    # 2. Ordena por score e corta o pool inicial para o LLM poder escolher melhor
+    order = np.argsort(-sims, kind="stable")[:limit]
+    return [index.items[rows[i]] for i in order]
+
+def _lexical_candidates(index: MenuIndex, req: SuggestionRequest, limit: int = MAX_RERANK_CANDIDATES) -> List[Dict[str, Any]]:
+    """
+    Busca só por termos (sem embedding), para quando a OpenAI de embeddings está fora.
+    Mesmos filtros, foco e exclusões da busca vetorial; pontua pela fração dos termos do pedido no item.
+    """
+    mask = build_filter_mask(index, req)
+    rows = index.candidate_rows(req.categoria_foco, req.excluded_ids, mask)
+    if not len(rows):
+        return []
+
+    scores = index.lexical_score(lexical_terms(f"{req.pedido_usuario} {req.preferencias or ''}"), rows)
+    # Se algum item tem termos do pedido, só esses entram. Se nenhum tem, fica o subconjunto
+    # do foco na ordem do índice, e o reranker (se estiver de pé) escolhe.
+    if scores.max() > 0:
+        keep = scores > 0
+        rows, scores = rows[keep], scores[keep]
+
+    boost = preference_boost(index, req)
+    if boost is not None:
+        scores = scores + boost[rows]
+
+    order = np.argsort(-scores, kind="stable")[:limit]
+    return [index.items[rows[i]] for i in order]
+
+def _cursor_page(session_id: str, restaurant_id: str, index: MenuIndex, req: SuggestionRequest) -> Optional[CandidateCursor]:
+    """Cursor da sessão se o pedido for um follow-up ("outra opção") da mesma busca e ainda houver candidatos."""
+    if not session_id or not req.excluded_ids:
+        return None
+    cursor = session_cursors.get(session_id)
+    if cursor is None:
+        outcome = "miss"
+    elif not cursor.matches(restaurant_id, index, req):
+        outcome = "stale"
+    elif not cursor.next_page(req.excluded_ids, 1):
+        outcome = "exhausted"
+    else:
+        metrics.inc("menux_session_cursor_total", result="hit")
+        return cursor
+    metrics.inc("menux_session_cursor_total", result=outcome)
+    return None
+
+async def agente_gastronomico(
+    req: SuggestionRequest, restaurant_id: str = "", speculation=None, session_id: str = ""
+) -> SuggestionResult:
     VisualLogger.log_tool_call("agente_gastronomico", req.model_dump())
     
     # 1. Start Cache se Vazio
-    cache_restante = CACHE_MENU_EMBEDDINGS.get(restaurant_id, {})
-    if not cache_restante:
-        await refresh_menu_embeddings(restaurant_id)
-        cache_restante = CACHE_MENU_EMBEDDINGS.get(restaurant_id, {})
-    
-    if not cache_restante:
+    index = await get_menu_index(restaurant_id)
+    if index is None:
         return SuggestionResult(sugestoes=[])
 
-    # 2. Vetoriza Query do Usuário
-    query_vec = await get_embedding(req.pedido_usuario)
-    if not query_vec:
-        return SuggestionResult(sugestoes=[])
-        
-    scored_items = []
-    
-    # 3. Busca Vetorial
-    for item_id, item in cache_restante.items():
-        # 0. Filtro de Exclusão (Evitar repetições)
-        if req.excluded_ids and item_id in req.excluded_ids:
-            continue
-
-        # Filtro Rigído de Categoria (opcional, ajuda a afunilar)
-        cat_name = item.get("category", {}).get("name", "").lower()
-        
-        # Soft Filter de Categoria (opcional)
-        # Se o usuário pediu "bebidas", podemos dar um "boost" em itens que contenham "bebida" ou similares no nome da categoria.
-        # Mas para ser 100% sem hardcode, confiamos PRIMARIAMENTE no embedding da Query.
-        # O embedding de "Quero beber algo refrescante" já vai trazer bebidas para o topo.
-        
-        # Opcional: Se 'categoria_foco' for definido e diferente de TODAS, podemos filtrar grosseiramente
-        # apenas se houver match de string óbvio, senão deixamos passar.
-        if req.categoria_foco != CategoriaProduto.TODAS:
-            foco_str = req.categoria_foco.value.lower().replace("_", " ")
-            cat_str = cat_name.lower()
-            
-            # Se a string da categoria NEM LEMBRA o foco, talvez pular?
-            # Mas "suco" não contem "bebidas". Então Hard Filter por string é perigoso sem hardcode.
-            # SOLUÇÃO: Não filtrar! A similaridade vetorial cuidará disso.
-            pass
-            
-        similarity = cosine_similarity(query_vec, item["embedding"])
-        
-        if similarity > 0.15: 
-            scored_items.append((similarity, item))
-            
-    # 4. Rankeamento com Serendipidade (Acaso)
-    # Ordena por score
-    scored_items.sort(key=lambda x: x[0], reverse=True)
-    
-    # Aumenta o pool inicial para o LLM poder escolher melhor
-    candidates_for_llm = [item for _, item in scored_items[:25]] 
-    
-    if not candidates_for_llm:
-        # Tenta fallback com itens aleatórios se a busca vetorial falhar muito
-        # Mas apenas se não tiver NADA.
-        pass
+    # 2. Follow-up ("outra opção" com excluded_ids): pagina a lista ranqueada da última busca
+    # da sessão, sem gerar embedding nem pontuar o cardápio de novo
+    cursor = _cursor_page(session_id, restaurant_id, index, req)
+    if cursor is not None:
+        candidates_for_llm = cursor.next_page(req.excluded_ids, MAX_RERANK_CANDIDATES)
+    else:
+        # 3. Vetoriza Query do Usuário
+        # Se o /chat já especulou o embedding da mensagem e o pedido bate com ela, reaproveita.
+        query_vec = await speculation.take(req.pedido_usuario) if speculation else None
+        if not query_vec:
+            query_vec = await get_embedding(req.pedido_usuario)
+
+        # 4. Busca Vetorial (com pré-filtro de categoria via índice)
+        # Se o usuário pediu "vinhos", só as categorias que o índice associou a VINHOS são pontuadas;
+        # se esse subconjunto for pequeno demais, o índice devolve o cardápio inteiro.
+        # Guardamos uma lista maior que a do reranker para os próximos "outra opção".
+        if query_vec:
+            pool = _vector_candidates(index, req, query_vec, limit=CURSOR_POOL_SIZE)
+        else:
+            # Embedding indisponível (erro, timeout ou circuito aberto): busca lexical no mesmo índice
+            record_fallback("lexical_search")
+            pool = _lexical_candidates(index, req, limit=CURSOR_POOL_SIZE)
+        candidates_for_llm = pool[:MAX_RERANK_CANDIDATES]
+        if session_id:
+            cursor = CandidateCursor(restaurant_id, index, req, pool)
+            session_cursors.put(session_id, cursor)
 
     # 5. Reranking Inteligente via LLM
-    # Isso resolve o problema de "algo leve" retornar Coca-Cola só porque tem "light" ou similaridade baixa.
-    # O LLM vai analisar os candidatos e filtrar o que realmente faz sentido.
-    
-    final_items = await _rank_items_with_llm(req.pedido_usuario, candidates_for_llm)
+    res = await _finalize_suggestions(req, candidates_for_llm)
+    if cursor is not None:
+        cursor.mark_shown([item.id for item in res.sugestoes])
+    VisualLogger.log_tool_result(res, success=bool(res.sugestoes))
+    return res
+
+async def _finalize_suggestions(req: SuggestionRequest, candidates: List[Dict[str, Any]], rerank: bool = True) -> SuggestionResult:
+    """Etapa final comum à tool e ao lote: reranking (opcional) + fallback Top 3 vetorial."""
+    final_items = []
+    if rerank:
+        # Isso resolve o problema de "algo leve" retornar Coca-Cola só porque tem "light" ou similaridade baixa.
+        # O LLM vai analisar os candidatos e filtrar o que realmente faz sentido.
+        final_items = await _rank_items_with_llm(req.pedido_usuario, candidates)
     
     # Se o LLM não retornar nada (erro ou filtro total), usar o Top 3 vetorial como fallback
-    if not final_items and candidates_for_llm:
-         final_items = candidates_for_llm[:3]
-
-    results = []
-    for item in final_items:
-        results.append(MenuItem(
-            id=item["id"],
-            nome=item["name"],
-            preco=str(item["price"]),
-            categoria=item.get("category", {}).get("name", "Outros"),
-            descricao=item.get("description", "") or "Sem descrição disponível."
-        ))
-
-    if not results:
-        res = SuggestionResult(sugestoes=[])
-        VisualLogger.log_tool_result(res, success=False)
-        return res
-
-    res = SuggestionResult(sugestoes=results)
-    VisualLogger.log_tool_result(res, success=True)
-    return res
+    if not final_items and candidates:
+         final_items = candidates[:3]
+
+    return SuggestionResult(sugestoes=[_to_menu_item(item) for item in final_items])
+
+async def recommend_batch(
+    index: MenuIndex,
+    queries: List[SuggestionRequest],
+    query_vecs: Optional[List[List[float]]],
+    rerank: bool = False,
+    max_concurrency: int = 4,
+):
+    """
+    Recomendações em lote: pontua TODAS as queries contra o cardápio em uma única
+    multiplicação de matrizes e roda o mesmo núcleo de busca da tool para cada uma.
+    Sem `query_vecs` (embeddings indisponíveis), usa a busca lexical, como a tool.
+    Gera (posição da query, SuggestionResult) na ordem em que ficam prontos.
+    """
+    if query_vecs:
+        # (itens x queries): coluna j = similaridade de cada item com a query j
+        scores = index.score_many(query_vecs)
+        candidates = [_vector_candidates(index, q, scores=scores[:, j]) for j, q in enumerate(queries)]
+    else:
+        record_fallback("lexical_search")
+        candidates = [_lexical_candidates(index, q) for q in queries]
+
+    if not rerank:
+        for j, q in enumerate(queries):
+            yield j, await _finalize_suggestions(q, candidates[j], rerank=False)
+        return
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _run(j: int):
+        async with semaphore:
+            return j, await _finalize_suggestions(queries[j], candidates[j])
+
+    # Tasks explícitas: se o cliente do NDJSON desconectar (gerador fechado/cancelado),
+    # os reranks ainda pendentes são cancelados em vez de seguir gastando chamadas pagas
+    tasks = [asyncio.create_task(_run(j)) for j in range(len(queries))]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# Prompt fixo do reranker. Vem primeiro e nunca muda, para o cache de prefixo da OpenAI reaproveitar.
+RERANK_SYSTEM_PROMPT = """Você é um especialista gastronômico inteligente.
+Sua tarefa é selecionar os MELHORES itens de uma lista de candidatos para atender ao pedido do usuário.
+Os candidatos vêm agrupados por [Categoria], um por linha: "número. Nome: descrição".
+
+Regras:
+1. Retorne APENAS um JSON com os NÚMEROS dos itens escolhidos, do melhor para o pior. Ex: {"ids": [4, 1]}
+2. Selecione de 0 a 3 itens. Se NENHUM item for adequado, retorne {"ids": []}.
+3. SEJA EXTREMAMENTE RIGOROSO.
+   - "Algo leve" -> APENAS saladas, peixes, grelhados leves ou entradas leves. NUNCA massas pesadas, frituras, carnes gordurosas ou frutos do mar.
+   - "Doce" -> APENAS sobremesas, bolos, chocolates. NUNCA pratos salgados.
+   - "Carne" -> APENAS carnes vermelhas. Frango e Peixe SÓ se o usuário pedir "carnes brancas" ou se não tiver outra opção.
+4. Se o pedido for "fome" ou genérico, você pode ser mais flexível.
+5. NÃO invente motivos. Se não serve, não mande. Melhor retornar lista vazia do que uma recomendação ruim."""
+
+# Orçamento de tokens da descrição de cada candidato (~4 caracteres por token em português)
+RERANK_DESC_MAX_TOKENS = 30
+_CHARS_PER_TOKEN = 4
+_TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+metrics.describe("menux_rerank_prompt_tokens", "Tokens de entrada por chamada do reranker.")
+metrics.describe("menux_rerank_completion_tokens", "Tokens de saída por chamada do reranker.")
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Corta o texto (na fronteira de palavra) para caber em ~`max_tokens` tokens."""
+    text = " ".join(text.split())
+    max_chars = max_tokens * _CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(" ", 1)[0].rstrip(",.;:-") + "…"
+
+def build_rerank_prompt(query: str, items: List[Dict[str, Any]]) -> Tuple[str, Dict[int, Dict[str, Any]]]:
+    """
+    Prompt do usuário com os candidatos em formato compacto e o mapa apelido -> item.
+    Os candidatos são ordenados por (categoria, nome, id), não pela similaridade: o mesmo
+    conjunto gera sempre o mesmo texto, e o pedido vai no fim para não quebrar o prefixo.
+    """
+    ordered = sorted(
+        items,
+        key=lambda item: ((item.get("category") or {}).get("name", ""), item.get("name", ""), str(item["id"])),
+    )
+    alias_map: Dict[int, Dict[str, Any]] = {}
+    lines: List[str] = []
+    current_category = None
+    for alias, item in enumerate(ordered, start=1):
+        category = (item.get("category") or {}).get("name", "") or "Outros"
+        if category != current_category:
+            lines.append(f"[{category}]")
+            current_category = category
+        description = _truncate_to_tokens(item.get("description") or "", RERANK_DESC_MAX_TOKENS)
+        lines.append(f"{alias}. {item['name']}: {description}" if description else f"{alias}. {item['name']}")
+        alias_map[alias] = item
+
+    candidates = "\n".join(lines)
+    return f"Candidatos:\n{candidates}\n\nPedido do usuário: \"{query}\"", alias_map
+
+def parse_rerank_aliases(data: Any, alias_map: Dict[int, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Converte a resposta do reranker (números dos candidatos) de volta em itens, sem repetir."""
+    # Tenta extrair a lista de várias formas comuns que o LLM pode mandar
+    aliases = []
+    if isinstance(data, list):
+        aliases = data
+    elif isinstance(data, dict):
+        for k in ["ids", "items", "recomendados", "ids_recomendados", "result"]:
+            if k in data and isinstance(data[k], list):
+                aliases = data[k]
+                break
+        # Se ainda não achou, pega o primeiro valor que for lista
+        if not aliases:
+            for v in data.values():
+                if isinstance(v, list):
+                    aliases = v
+                    break
+
+    # O modelo às vezes devolve o id original em vez do número
+    by_id = {str(item["id"]): item for item in alias_map.values()}
+    ranked: List[Dict[str, Any]] = []
+    seen = set()
+    for alias in aliases:
+        item = None
+        if isinstance(alias, int) and not isinstance(alias, bool):
+            item = alias_map.get(alias)
+        elif isinstance(alias, str):
+            key = alias.strip()
+            item = alias_map.get(int(key)) if key.isdigit() else by_id.get(key)
+        if item is not None and item["id"] not in seen:
+            seen.add(item["id"])
+            ranked.append(item)
+    return ranked[:3]
+
+async def _rerank_completion(user_prompt: str):
+    # Breaker só em volta da chamada: o wait_for do orçamento fica por fora e não conta como falha
+    async with chat_circuit.guard():
+        return await get_openai_client().chat.completions.create(
+            model=RERANK_MODEL,
+            messages=[
+                {"role": "system", "content": RERANK_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0.0,
+            response_format={"type": "json_object"},
+            timeout=RERANK_TIMEOUT,
+        )
 
 async def _rank_items_with_llm(query: str, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
@@ -295,82 +700,47 @@ async def _rank_items_with_llm(query: str, items: List[Dict[str, Any]]) -> List[
     """
     if not items: return []
     
-    # Prepara o prompt
-    items_str = ""
-    item_map = {}
-    for item in items:
-        # Sanitiza para economizar tokens e evitar confusão
-        i_str = f"ID: {item['id']} | Nome: {item['name']} | Desc: {item.get('description','')} | Cat: {item.get('category',{}).get('name','')}"
-        items_str += f"- {i_str}\n"
-        item_map[item['id']] = item
-
-    system_prompt = """
-    Você é um especialista gastrômico inteligente. 
-    Sua tarefa é selecionar os MELHORES itens de uma lista de candidatos para atender ao pedido do usuário.
-    
-    Regras:
-    1. Retorne APENAS um JSON array de strings com os IDs dos itens escolhidos. Ex: ["id1", "id2"]
-    2. Selecione de 0 a 3 itens. Se NENHUM item for adequado, retorne [].
-    3. SEJA EXTREMAMENTE RIGOROSO. 
-       - "Algo leve" -> APENAS saladas, peixes, grelhados leves ou entradas leves. NUNCA massas pesadas, frituras, carnes gordurosas ou frutos do mar.
-       - "Doce" -> APENAS sobremesas, bolos, chocolates. NUNCA pratos salgados.
-       - "Carne" -> APENAS carnes vermelhas. Frango e Peixe SÓ se o usuário pedir "carnes brancas" ou se não tiver outra opção.
-    4. Se o pedido for "fome" ou genérico, você pode ser mais flexível.
-    5. NÃO invente motivos. Se não serve, não mande. Melhor retornar lista vazia do que uma recomendação ruim.
-    """
-    
-    user_prompt = f"""
-    Pedido do Usuário: "{query}"
-    
-    Candidatos (Vetor Search):
-    {items_str}
-    
-    Quais desses itens realmente atendem ao pedido? Responda com JSON array de IDs.
-    """
+    # Candidatos com apelidos numéricos e descrições curtas: menos tokens de entrada e de saída
+    user_prompt, alias_map = build_rerank_prompt(query, items)
     
+    # O reranker fica com o que sobrar do orçamento (menos a reserva da resposta final do agente)
+    timeout = time_left(RERANK_TIMEOUT, reserve=RERANK_RESERVE_SECONDS)
+    if timeout < MIN_RERANK_BUDGET:
+        record_fallback("rerank_skipped")
+        return []
+    if chat_circuit.is_open():
+        record_fallback("rerank_circuit_open")
+        return []
+
     try:
-        resp = await openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.0,
-            response_format={"type": "json_object"} 
-        )
+        async with llm_scheduler.slot():
+            resp = await asyncio.wait_for(_rerank_completion(user_prompt), timeout=budget_wait(timeout, RERANK_TIMEOUT))
+        if resp.usage:
+            details = resp.usage.prompt_tokens_details
+            record_usage(
+                "rerank",
+                RERANK_MODEL,
+                input_tokens=resp.usage.prompt_tokens,
+                output_tokens=resp.usage.completion_tokens,
+                cached_tokens=(details.cached_tokens or 0) if details else 0,
+            )
+            metrics.observe("menux_rerank_prompt_tokens", resp.usage.prompt_tokens, buckets=_TOKEN_BUCKETS)
+            metrics.observe("menux_rerank_completion_tokens", resp.usage.completion_tokens, buckets=_TOKEN_BUCKETS)
         
         content = resp.choices[0].message.content
         import json
-        data = json.loads(content)
-        
-        # Tenta extrair a lista de IDs de várias formas comuns que o LLM pode mandar
-        ids = []
-        if isinstance(data, list):
-            ids = data
-        elif isinstance(data, dict):
-            # Procura chaves comuns
-            for k in ["ids", "items", "recomendados", "ids_recomendados", "result"]:
-                if k in data and isinstance(data[k], list):
-                    ids = data[k]
-                    break
-            
-            # Se ainda não achou, pega o primeiro valor que for lista
-            if not ids:
-                for v in data.values():
-                    if isinstance(v, list):
-                        ids = v
-                        break 
-            
-        ranked_items = []
-        for i_id in ids:
-            if i_id in item_map:
-                ranked_items.append(item_map[i_id])
-                
-        # Fallback de segurança: se o LLM retornou IDs validos, usa.
         # Se retornou vazio, é pq REALMENTE não achou nada bom (filtro rigoroso).
-        return ranked_items
+        return parse_rerank_aliases(json.loads(content), alias_map)
         
+    except CircuitOpen:
+        record_fallback("rerank_circuit_open")
+        return []
+    except asyncio.TimeoutError:
+        print(f"Timeout no Reranking LLM ({timeout:.1f}s), usando Top 3 vetorial")
+        record_fallback("rerank_timeout")
+        return []
     except Exception as e:
         print(f"Erro no Reranking LLM: {e}")
+        record_fallback("rerank_timeout" if _is_client_timeout(e) else "rerank_error")
         return [] # Em caso de erro, retorna vazio para o caller usar fallback
 
@@ -0,0 +1,85 @@
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Tuple
+
+from . import metrics
+from .scheduler import current_restaurant
+
+# Preço por 1M de tokens (USD): entrada, entrada em cache, saída. Atualizar quando a OpenAI mudar a tabela.
+MODEL_PRICES_PER_MTOK: Dict[str, Tuple[float, float, float]] = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "text-embedding-3-small": (0.02, 0.02, 0.0),
+}
+
+metrics.describe("menux_llm_requests_total", "Chamadas à OpenAI por restaurante, tool e modelo.")
+metrics.describe("menux_llm_tokens_total", "Tokens consumidos (kind = input, output, cached) por restaurante, tool e modelo.")
+metrics.describe("menux_llm_cost_usd_total", "Custo estimado (USD) por restaurante, tool e modelo.")
+metrics.describe("menux_agent_round_trips", "Idas ao LLM do agente por turno de /chat.")
+
+_COUNTERS = ("requests", "input_tokens", "output_tokens", "cached_tokens")
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int, cached_tokens: int) -> float:
+    """Custo em USD. `cached_tokens` é a parte de `input_tokens` que veio do cache de prompt."""
+    input_price, cached_price, output_price = MODEL_PRICES_PER_MTOK.get(model, (0.0, 0.0, 0.0))
+    cached = min(cached_tokens, input_tokens)
+    return ((input_tokens - cached) * input_price + cached * cached_price + output_tokens * output_price) / 1_000_000
+
+
+class UsageRecord:
+    """Consumo de uma requisição, somado por (tool, modelo). Carregado via `current_usage`, como o `Deadline`."""
+
+    def __init__(self, restaurant_id: str = ""):
+        self.restaurant_id = restaurant_id
+        self.calls: Dict[Tuple[str, str], Dict[str, int]] = {}
+        self.agent_round_trips = 0
+
+    def add(self, tool: str, model: str, requests: int, input_tokens: int, output_tokens: int, cached_tokens: int):
+        entry = self.calls.setdefault((tool, model), dict.fromkeys(_COUNTERS, 0))
+        entry["requests"] += requests
+        entry["input_tokens"] += input_tokens
+        entry["output_tokens"] += output_tokens
+        entry["cached_tokens"] += cached_tokens
+
+    def to_dict(self) -> Dict[str, Any]:
+        by_call = []
+        total: Dict[str, Any] = dict.fromkeys(_COUNTERS, 0)
+        total["cost_usd"] = 0.0
+        for (tool, model), entry in self.calls.items():
+            cost = estimate_cost(model, entry["input_tokens"], entry["output_tokens"], entry["cached_tokens"])
+            by_call.append({"tool": tool, "model": model, **entry, "cost_usd": round(cost, 6)})
+            for key in _COUNTERS:
+                total[key] += entry[key]
+            total["cost_usd"] += cost
+        total["cost_usd"] = round(total["cost_usd"], 6)
+        return {
+            "restaurant": self.restaurant_id,
+            "agent_round_trips": self.agent_round_trips,
+            "total": total,
+            "by_call": by_call,
+        }
+
+
+current_usage: ContextVar[Optional[UsageRecord]] = ContextVar("current_usage", default=None)
+
+
+def record_usage(
+    tool: str,
+    model: str,
+    input_tokens: int = 0,
+    output_tokens: int = 0,
+    cached_tokens: int = 0,
+    requests: int = 1,
+):
+    """Registra uma chamada à OpenAI nas métricas e no registro da requisição atual (se houver)."""
+    usage = current_usage.get()
+    restaurant = (usage.restaurant_id if usage else "") or current_restaurant.get() or "default"
+    labels = {"restaurant": restaurant, "tool": tool, "model": model}
+
+    metrics.inc("menux_llm_requests_total", requests, **labels)
+    metrics.inc("menux_llm_tokens_total", input_tokens, kind="input", **labels)
+    metrics.inc("menux_llm_tokens_total", output_tokens, kind="output", **labels)
+    metrics.inc("menux_llm_tokens_total", cached_tokens, kind="cached", **labels)
+    metrics.inc("menux_llm_cost_usd_total", estimate_cost(model, input_tokens, output_tokens, cached_tokens), **labels)
+
+    if usage is not None:
+        usage.add(tool, model, requests, input_tokens, output_tokens, cached_tokens)
@@ -1,13 +1,12 @@
 import asyncio
-import os
-from dotenv import load_dotenv
+from app.config import get_settings
 from app.agent import menux_agent
 from app.logger import VisualLogger
 from app.tools import fetch_category_names, refresh_menu_embeddings
 from app.models import MenuxDeps
 
 # Carrega variáveis de ambiente
-load_dotenv()
+settings = get_settings()
 
 async def main():
     print("--- Menux (Python/PydanticAI) ---")
@@ -18,7 +17,6 @@ async def main():
     # Pre-loading de contexto
     print(f"🤖 Carregando categorias do cardápio para {restaurant_id}...")
     cats_context = await fetch_category_names(restaurant_id)
-    deps = MenuxDeps(categorias_str=cats_context, restaurantId=restaurant_id)
     print("✅ Categorias Carregadas!")
     
     # Warmup do Cache de Embeddings
@@ -41,7 +39,8 @@ async def main():
             VisualLogger.log_user(user_input)
             VisualLogger.log_agent_start()
             
-            # Executa o agente
+            # Executa o agente (deps novas por turno, como no /chat)
+            deps = MenuxDeps(categorias_str=cats_context, restaurantId=restaurant_id)
             result = await menux_agent.run(user_input, message_history=messages, deps=deps)
             
             # Atualiza histórico
@@ -54,7 +53,7 @@ async def main():
             print(f"Erro: {e}")
 
 if __name__ == "__main__":
-    if not os.getenv("OPENAI_API_KEY"):
+    if not settings.openai_api_key:
         print("AVISO: OPENAI_API_KEY não encontrada no ambiente. O agente pode falhar se tentar chamar a API real.")
     
     asyncio.run(main())
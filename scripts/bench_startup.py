@@ -0,0 +1,108 @@
+"""
+Benchmark de cold start da API.
+
+Mede:
+  - tempo de `import api` (mediana de N processos novos)
+  - tempo até a primeira resposta HTTP e até o pod ficar pronto para /chat:
+    sobe `uvicorn api:app` e faz polling em /health (503 durante o aquecimento, 200 quando pronto)
+
+Uso (na raiz do projeto):
+    python scripts/bench_startup.py
+    python scripts/bench_startup.py --runs 10 --top 15   # + módulos mais lentos (-X importtime)
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Tuple
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import api; print(time.perf_counter() - t)"
+
+
+def measure_import(runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET], cwd=ROOT, capture_output=True, text=True, check=True
+        )
+        samples.append(float(out.stdout.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+
+def top_imports(top: int):
+    """Módulos com maior tempo cumulativo no `-X importtime`."""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import api"], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # "import time: <self us> | <cumulative us> | <módulo>"
+        _, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(cumulative_us), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def measure_startup(port: int, timeout: float) -> Tuple[float, float]:
+    """(primeira resposta HTTP, pronto para /chat) em segundos desde o spawn do uvicorn."""
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        url = f"http://127.0.0.1:{port}/health"
+        first_response = None
+        while time.perf_counter() - start < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError("uvicorn encerrou antes de responder")
+            try:
+                with urllib.request.urlopen(url, timeout=0.5) as resp:
+                    if resp.status == 200:
+                        ready = time.perf_counter() - start
+                        return first_response or ready, ready
+            except urllib.error.HTTPError:
+                # 503: já responde, mas ainda aquecendo
+                first_response = first_response or time.perf_counter() - start
+                time.sleep(0.02)
+            except OSError:
+                time.sleep(0.02)
+        raise TimeoutError(f"/health não ficou pronto em {timeout}s")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de cold start da API Menux")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--top", type=int, default=0, help="Lista os N módulos mais lentos de importar")
+    args = parser.parse_args()
+
+    print(f"import api (mediana de {args.runs}): {measure_import(args.runs) * 1000:.0f} ms")
+
+    samples = [measure_startup(args.port, args.timeout) for _ in range(args.runs)]
+    first = statistics.median(s[0] for s in samples)
+    ready = statistics.median(s[1] for s in samples)
+    print(f"primeira resposta /health (mediana de {args.runs}): {first * 1000:.0f} ms")
+    print(f"pronto para /chat (mediana de {args.runs}): {ready * 1000:.0f} ms")
+
+    if args.top:
+        print(f"\nTop {args.top} imports (cumulativo):")
+        for cumulative_us, name in top_imports(args.top):
+            print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()